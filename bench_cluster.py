@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# firm clustering checks and benchmarks on synthetic names
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from multiprocessing import Pool
+
+import simhash as sh
+
+# distinct names built from a shared vocabulary so there are plenty of near duplicates
+def synth_names(num, seed=0):
+    rng = np.random.default_rng(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocab = [''.join(letters[c] for c in rng.integers(0, 26, size=n)) for n in rng.integers(2, 10, size=max(num//20, 100))]
+    vocab += ['corp', 'inc', 'co', 'ltd', 'gmbh', 'kabushiki kaisha', 'company', 'international']
+    words = rng.integers(0, len(vocab), size=(num, 5)).tolist()
+    sizes = rng.integers(1, 6, size=num).tolist()
+    return list(dict.fromkeys(' '.join(vocab[w] for w in ws[:n]) for ws, n in zip(words, sizes)))
+
+# compiled batch signatures against the pure python Simhash, then batch timings by thread count
+def check_simhash(num, nshingle=2, nref=5_000, threads=None):
+    names = synth_names(num)
+    num = len(names)
+    features, offsets, weights = sh.features_csr(names, nshingle)
+    hashes = sh.hash_features(features)
+
+    py = sh.Simhash()
+    cs = sh.CSimhash()
+    signs = sh.simhash_hashed(hashes, offsets, weights)
+    same = True
+    for i in range(min(nref, num)):
+        f, w = features[offsets[i]:offsets[i+1]], list(weights[offsets[i]:offsets[i+1]])
+        same &= py.simhash(f, w) == signs[i] == cs.simhash(f, w)
+    print(f'{min(nref, num)} names: batch == Simhash == CSimhash: {same}')
+
+    t0 = time.perf_counter()
+    for i in range(num):
+        cs.simhash(features[offsets[i]:offsets[i+1]], weights[offsets[i]:offsets[i+1]])
+    tone = time.perf_counter() - t0
+    print(f'one at a time: {num} names in {tone:.2f}s')
+
+    for nthreads in threads or sorted({1, os.cpu_count() or 1}):
+        t0 = time.perf_counter()
+        sh.simhash_hashed(hashes, offsets, weights, nthreads=nthreads)
+        tbatch = time.perf_counter() - t0
+        print(f'batch, {nthreads} threads: {num} names in {tbatch:.3f}s ({tone/tbatch:.0f}x)')
+
+    return same
+
+# runs in a fresh process: band matching on precomputed signatures, dict based or array based,
+# the array index either collecting all pairs or streaming them in batches like filter_pairs
+# timed first, then again under tracemalloc for the peak memory of the structures themselves
+def band_profile(method, signs, k, thresh, cap=None):
+    def run():
+        labels = np.arange(len(signs))
+        if method == 'dict':
+            c = sh.Cluster(k=k, thresh=thresh)
+            for sign, label in zip(signs, labels.tolist()):
+                c.add_sign(sign, label)
+            return c.unions
+        index = sh.BandIndex(k=k, thresh=thresh, cap=cap)
+        index.add(signs, labels)
+        if method == 'array':
+            return index.pairs()
+        return sum(len(id1) for id1, _, _ in index.iter_pairs())
+
+    t0 = time.perf_counter()
+    run()
+    delta = time.perf_counter() - t0
+
+    tracemalloc.start()
+    pairs = run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if method == 'array':
+        id1, id2, _ = pairs
+        pairs = list(zip(id1.tolist(), id2.tolist()))
+    elif method == 'stream':
+        return pairs, delta, peak/1e6
+    return set(pairs), delta, peak/1e6
+
+# Cluster (dicts of lists) versus BandIndex (sorted arrays, optionally with capped buckets): same pairs, time and memory
+def check_bands(num, k=8, thresh=4, cap=None, nshingle=2):
+    names = synth_names(num)
+    features, offsets, weights = sh.features_csr(names, nshingle)
+    signs = sh.simhash_batch(features, offsets, weights)
+    del names, features, offsets, weights
+
+    result = {}
+    for method in ['dict', 'array', 'stream']:
+        with Pool(1, maxtasksperchild=1) as pool:
+            pairs, delta, mem = pool.apply(band_profile, (method, signs, k, thresh, cap))
+        npairs = pairs if method == 'stream' else len(pairs)
+        print(f'{method}: {len(signs)} names, {npairs} pairs in {delta:.2f}s, peak memory {mem:.1f} MB')
+        result[method] = pairs
+
+    same = result['dict'] == result['array'] and result['stream'] == len(result['array'])
+    print(f'identical pairs: {same}')
+    return same
+
+# permutation tables against a brute force scan: same neighbors for a sample of queries, then timings
+def check_perm(num, radius=3, blocks=None, nquery=1_000, nshingle=2):
+    names = synth_names(num)
+    features, offsets, weights = sh.features_csr(names, nshingle)
+    signs = sh.simhash_batch(features, offsets, weights)
+    labels = np.arange(len(signs))
+
+    t0 = time.perf_counter()
+    index = sh.PermIndex(radius=radius, blocks=blocks)
+    index.add(signs, labels)
+    tbuild = time.perf_counter() - t0
+
+    queries = signs[:nquery]
+    t0 = time.perf_counter()
+    qpos, found, _ = index.query_batch(queries)
+    tquery = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    same = True
+    for i, sign in enumerate(queries):
+        scan = set(labels[sh.hamming(sign, signs) <= radius].tolist())
+        same &= scan == set(found[qpos == i].tolist())
+    tscan = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    npairs = sum(len(id1) for id1, _, _ in index.iter_pairs())
+    tpairs = time.perf_counter() - t0
+
+    print(f'{len(signs)} names, {len(index.masks)} tables: built in {tbuild:.2f}s')
+    print(f'{len(queries)} queries: {tquery:.3f}s indexed, {tscan:.3f}s scanning, same neighbors: {same}')
+    print(f'all pairs within {radius}: {npairs} in {tpairs:.2f}s')
+    return same
+
+# compiled batch similarity against distance.levenshtein one pair at a time
+def check_levenshtein(num, npairs, thresh=0.85, nref=20_000):
+    from math import ceil
+    try:
+        from distance.cdistance import levenshtein
+        impl = 'c'
+    except ImportError:
+        from distance import levenshtein
+        impl = 'python'
+    import cluster
+
+    names = synth_names(num)
+    rng = np.random.default_rng(1)
+    pos1 = rng.integers(0, len(names), size=npairs)
+    pos2 = rng.integers(0, len(names), size=npairs)
+    chars, offsets = cluster.encode_names(names)
+
+    t0 = time.perf_counter()
+    sims = cluster.levcore.levsim_batch(chars, offsets, pos1, pos2, thresh)
+    tbatch = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ref = []
+    for p1, p2 in zip(pos1[:nref], pos2[:nref]):
+        name1, name2 = names[p1], names[p2]
+        max_len = max(len(name1), len(name2))
+        ldist = levenshtein(name1, name2, max_dist=int(ceil(max_len*(1.0-thresh))))
+        ref.append((1.0 - float(ldist)/max_len) if (ldist != -1 and max_len != 0) else 0.0)
+    tref = (time.perf_counter() - t0)*npairs/min(nref, npairs)
+
+    same = np.array_equal(sims[:nref], np.array(ref))
+    print(f'{npairs} pairs: batch {tbatch:.2f}s, distance.levenshtein ({impl}) {tref:.2f}s (extrapolated), same scores: {same}')
+    return same
+
+# runs in a fresh process: components of an edge list with networkx or union-find on arrays,
+# timed and then under tracemalloc, returns the component number of every node
+def components_profile(method, id1, id2):
+    def run():
+        if method == 'networkx':
+            import networkx as nx
+            G = nx.Graph()
+            G.add_edges_from(zip(id1.tolist(), id2.tolist()))
+            return sorted(nx.connected_components(G), key=len, reverse=True)
+        else:
+            import cluster
+            return cluster.components(id1, id2)
+
+    t0 = time.perf_counter()
+    run()
+    delta = time.perf_counter() - t0
+
+    tracemalloc.start()
+    comps = run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if method == 'networkx':
+        labels = {i: fid for fid, ids in enumerate(comps) for i in ids}
+    else:
+        labels = dict(zip(comps[0].tolist(), comps[1].tolist()))
+    return labels, delta, peak/1e6
+
+# array union-find against networkx on random edges: same numbering, time and memory
+def check_components(num, nedges):
+    rng = np.random.default_rng(2)
+    id1 = rng.integers(0, num, size=nedges)
+    id2 = rng.integers(0, num, size=nedges)
+
+    result = {}
+    for method in ['networkx', 'array']:
+        with Pool(1, maxtasksperchild=1) as pool:
+            labels, delta, mem = pool.apply(components_profile, (method, id1, id2))
+        print(f'{method}: {nedges} edges, {max(labels.values())+1} components in {delta:.2f}s, peak memory {mem:.1f} MB')
+        result[method] = labels
+
+    same = result['networkx'] == result['array']
+    print(f'identical numbering: {same}')
+    return same
+
+# every substitution in order with no gates, as standardize_strong used to be
+def strong_passes(name):
+    import standardize as st
+    name = name.lower()
+    name = st.post0_re.sub('', name)
+    for pat, rep in [(st.acronym1_re, r'\1\2\3'), (st.acronym2_re, r'\1\2'), (st.acronym3_re, r'\1\2\3'), (st.acronym4_re, r'\1\2'),
+                     (st.acronym5_re, r'\1\2'), (st.acronym6_re, r'\1\2'), (st.acronym7_re, r'\1\2'), (st.punct0_re, ''),
+                     (st.punct1_re, ' '), (st.gener0_re, ''), (st.white0_re, ' ')]:
+        name = pat.sub(rep, name)
+    return name.strip()
+
+# raw applicant style names: synthetic names with firm suffixes, punctuation and acronyms, each
+# one repeated a few times like the same applicant on many patents
+def synth_raw(num, seed=0):
+    rng = np.random.default_rng(seed)
+    extra = ['', '', '', ' Inc.', ' Corp.', ', a corp. of Delaware', ' Co., Ltd.', ' (USA)', ' GmbH & Co. KG', ' S.A. de C.V.']
+    lead = ['', '', '', 'The ', 'A B C ', 'I-B-M ', 'AT&T ', 'R & D ']
+    names = [lead[a] + n.title() + extra[b] for n, a, b in zip(synth_names(num//3, seed), rng.integers(0, len(lead), size=num).tolist(), rng.integers(0, len(extra), size=num).tolist())]
+    return [names[i] for i in rng.integers(0, len(names), size=num).tolist()]
+
+# gated standardize_strong against every pass, then batch (distinct names once) against one per row
+def check_standardize(num):
+    import pandas as pd
+    import standardize as st
+
+    raw = synth_raw(num)
+    weak = st.standardize_batch(raw, st.standardize_weak)
+    uniq = list(dict.fromkeys(weak))
+    same = [st.standardize_strong(n) for n in uniq] == [strong_passes(n) for n in uniq]
+    print(f'{len(uniq)} distinct names: gated == every pass: {same}')
+
+    t0 = time.perf_counter()
+    ser = pd.Series(raw)
+    ser.apply(st.standardize_weak).apply(strong_passes)
+    trow = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    st.standardize_batch(st.standardize_batch(raw, st.standardize_weak), st.standardize_strong)
+    tbatch = time.perf_counter() - t0
+    print(f'{num} rows: per row {trow:.2f}s, batch {tbatch:.2f}s ({trow/tbatch:.1f}x)')
+    return same
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='firm clustering checks and benchmarks on synthetic names')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    simhash = subparsers.add_parser('simhash', help='check and time batch signatures')
+    simhash.add_argument('--num', type=int, default=200_000, help='number of names')
+    simhash.add_argument('--nref', type=int, default=5_000, help='names to check against pure python')
+    simhash.add_argument('--threads', type=int, nargs='*', default=None, help='thread counts to time')
+
+    bands = subparsers.add_parser('bands', help='compare band matching memory')
+    bands.add_argument('--num', type=int, default=100_000, help='number of names')
+    bands.add_argument('--k', type=int, default=8, help='number of bands')
+    bands.add_argument('--thresh', type=int, default=4, help='bands that must agree (more than)')
+    bands.add_argument('--cap', type=int, default=None, help='bucket cap for the array index (split overflow)')
+
+    perm = subparsers.add_parser('perm', help='check permutation table lookups')
+    perm.add_argument('--num', type=int, default=200_000, help='number of names')
+    perm.add_argument('--radius', type=int, default=3, help='hamming radius')
+    perm.add_argument('--blocks', type=int, default=None, help='number of blocks (default radius + 3)')
+    perm.add_argument('--nquery', type=int, default=1_000, help='queries to check against a scan')
+
+    lev = subparsers.add_parser('levenshtein', help='check batch edit distance similarity')
+    lev.add_argument('--num', type=int, default=100_000, help='number of names')
+    lev.add_argument('--pairs', type=int, default=1_000_000, help='number of random pairs')
+    lev.add_argument('--thresh', type=float, default=0.85, help='similarity threshold')
+
+    comp = subparsers.add_parser('components', help='compare firm grouping with networkx')
+    comp.add_argument('--num', type=int, default=1_000_000, help='number of nodes')
+    comp.add_argument('--edges', type=int, default=2_000_000, help='number of random edges')
+
+    std = subparsers.add_parser('standardize', help='check and time batch standardization')
+    std.add_argument('--num', type=int, default=300_000, help='number of raw names')
+
+    args = parser.parse_args()
+
+    if args.cmd == 'simhash':
+        ok = check_simhash(args.num, nref=args.nref, threads=args.threads)
+    elif args.cmd == 'bands':
+        ok = check_bands(args.num, k=args.k, thresh=args.thresh, cap=args.cap)
+    elif args.cmd == 'perm':
+        ok = check_perm(args.num, radius=args.radius, blocks=args.blocks, nquery=args.nquery)
+    elif args.cmd == 'levenshtein':
+        ok = check_levenshtein(args.num, args.pairs, thresh=args.thresh)
+    elif args.cmd == 'components':
+        ok = check_components(args.num, args.edges)
+    elif args.cmd == 'standardize':
+        ok = check_standardize(args.num)
+    sys.exit(0 if ok else 1)
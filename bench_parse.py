@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# parser checks and benchmarks on synthetic data
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+import resource
+import tempfile
+import argparse
+from itertools import zip_longest
+from multiprocessing import Pool
+
+import synth_data as sd
+import parse_grant
+import parse_apply
+from parse_grant import iter_grants
+from parse_apply import iter_applications
+from parse_store import ipc_rows, write_ipcs
+from perf import git_commit
+
+iterators = {
+    'gen1': iter_grants,
+    'pgb': iter_grants,
+    'ipgb': iter_grants,
+    'pab': iter_applications,
+    'ipab': iter_applications,
+}
+
+# gen 1 is memory mapped, so its rss tracks the file size and it's left out of the memory check
+xml_formats = ['pgb', 'ipgb', 'pab', 'ipab']
+
+# ptype, module and id key for the write path
+writers = {
+    'gen1': ('grant', parse_grant, 'patnum'),
+    'pgb': ('grant', parse_grant, 'patnum'),
+    'ipgb': ('grant', parse_grant, 'patnum'),
+    'pab': ('apply', parse_apply, 'appnum'),
+    'ipab': ('apply', parse_apply, 'appnum'),
+}
+
+# peak resident memory of this process in MB (linux reports kb)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# peak rss after the first tenth of the documents versus after all of them
+def memory_profile(fmt, num):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = sd.make_file(fmt, num, outdir=tmp)
+        base = None
+        for i, _ in enumerate(iterators[fmt](path), 1):
+            if i == max(1, num // 10):
+                base = peak_rss()
+        return i, base, peak_rss()
+
+# each format runs in a fresh process so the peaks don't bleed into each other
+def check_memory(formats, num, tol):
+    ok = True
+    with Pool(1, maxtasksperchild=1) as pool:
+        for fmt in formats:
+            n, base, peak = pool.apply(memory_profile, (fmt, num))
+            grow = peak - base
+            flat = grow <= tol
+            ok &= flat
+            print(f'{fmt}: {n} docs, peak rss {base:.1f} MB -> {peak:.1f} MB ({grow:+.1f} MB) {"ok" if flat else "FAIL"}')
+    return ok
+
+# gen 1 record engine versus the line engine: same rows, how much faster
+def bench_gen1(num, reps=3):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = sd.make_file('gen1', num, outdir=tmp)
+        size = os.path.getsize(path)/1e6
+
+        for engine in ['lines', 'records']:
+            best = float('inf')
+            for _ in range(reps):
+                t0 = time.perf_counter()
+                n = sum(1 for _ in iter_grants(path, engine=engine))
+                best = min(best, time.perf_counter() - t0)
+            print(f'{engine}: {n} docs in {best:.2f}s ({n/best:.0f} docs/s, {size/best:.1f} MB/s)')
+            if engine == 'lines':
+                base = best
+
+        same = all(p1 == p2 for p1, p2 in zip_longest(iter_grants(path, engine='lines'), iter_grants(path, engine='records')))
+        print(f'speedup: {base/best:.2f}x, identical rows: {same}')
+
+        # same file with windows and old mac line endings should give the same rows
+        with open(path, 'rb') as f:
+            data = f.read()
+        for name, eol in [('crlf', b'\r\n'), ('cr', b'\r')]:
+            vpath = os.path.join(tmp, name, os.path.basename(path))
+            os.makedirs(os.path.dirname(vpath))
+            with open(vpath, 'wb') as f:
+                f.write(data.replace(b'\n', eol))
+            vsame = all(p1 == p2 for p1, p2 in zip_longest(iter_grants(path, engine='lines'), iter_grants(vpath, engine='records')))
+            print(f'{name} line endings, identical rows: {vsame}')
+            same &= vsame
+    return same
+
+# runs in a fresh process: parse rate and peak rss, then the sqlite write path on its own
+def bench_format(fmt, path, reps=3, chunk=1000):
+    size = os.path.getsize(path)/1e6
+
+    tparse = float('inf')
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        n = sum(1 for _ in iterators[fmt](path))
+        tparse = min(tparse, time.perf_counter() - t0)
+    rss = peak_rss()
+
+    # same batches as the parsers' own main loops, into a scratch database
+    ptype, mod, key = writers[fmt]
+    pats = [(list(p.values()), (p[key], ipc_rows(p))) for p in iterators[fmt](path)]
+    twrite = float('inf')
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(reps):
+            con = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+            cur = con.cursor()
+            mod.init_db(cur, clobber=True)
+            con.commit()
+            t0 = time.perf_counter()
+            for i in range(0, len(pats), chunk):
+                batch = pats[i:i+chunk]
+                cur.executemany(mod.insert_cmd, [r for r, _ in batch])
+                write_ipcs(cur, ptype, key, [c for _, c in batch])
+                con.commit()
+            twrite = min(twrite, time.perf_counter() - t0)
+            con.close()
+
+    return {
+        'format': fmt, 'docs': n, 'mb': round(size, 2),
+        'parse_s': round(tparse, 3), 'docs_s': round(n/tparse), 'mb_s': round(size/tparse, 2), 'rss_mb': round(rss, 1),
+        'write_s': round(twrite, 3), 'write_docs_s': round(n/twrite),
+    }
+
+# one json line per format per run, appended to the results file
+def bench_all(formats, num, reps, output=None):
+    meta = {
+        'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'machine': platform.machine(), 'num': num,
+    }
+    print(f'{"format":>6} {"docs":>7} {"MB":>7} {"docs/s":>8} {"MB/s":>6} {"rss MB":>7} {"write/s":>8}')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in formats:
+            path = sd.make_file(fmt, num, outdir=tmp)
+            with Pool(1, maxtasksperchild=1) as pool:
+                res = pool.apply(bench_format, (fmt, path, reps))
+            print(f'{fmt:>6} {res["docs"]:7d} {res["mb"]:7.1f} {res["docs_s"]:8d} {res["mb_s"]:6.1f} {res["rss_mb"]:7.1f} {res["write_docs_s"]:8d}')
+            results.append({**meta, **res})
+            os.remove(path)
+
+    if output is not None:
+        with open(output, 'a') as f:
+            for res in results:
+                f.write(json.dumps(res) + '\n')
+    return results
+
+# docs/s (parse and write) by commit for each format, oldest first
+def show_history(path, formats=None, last=10):
+    with open(path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    runs = []
+    for res in results:
+        run = (res['commit'], res['time'], res['num'])
+        if run not in runs:
+            runs.append(run)
+    runs = runs[-last:]
+    if formats is None or len(formats) == 0:
+        formats = list(dict.fromkeys(res['format'] for res in results))
+
+    print(f'{"commit":>10} {"time":>19} {"docs":>7} ' + ' '.join(f'{fmt:>13}' for fmt in formats))
+    for run in runs:
+        stats = {res['format']: res for res in results if (res['commit'], res['time'], res['num']) == run}
+        cells = [f'{stats[fmt]["docs_s"]:6d}/{stats[fmt]["write_docs_s"]:<6d}' if fmt in stats else f'{"-":>13}' for fmt in formats]
+        commit, tstamp, num = run
+        print(f'{commit or "?":>10} {tstamp:>19} {num:7d} ' + ' '.join(cells))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='parser checks and benchmarks on synthetic data')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    memory = subparsers.add_parser('memory', help='check that peak memory stays flat')
+    memory.add_argument('formats', type=str, nargs='*', default=xml_formats, help='formats to check')
+    memory.add_argument('--num', type=int, default=20_000, help='documents per synthetic file')
+    memory.add_argument('--tol', type=float, default=10.0, help='allowed peak rss growth in MB')
+
+    gen1 = subparsers.add_parser('gen1', help='compare gen 1 engines')
+    gen1.add_argument('--num', type=int, default=50_000, help='documents in synthetic file')
+    gen1.add_argument('--reps', type=int, default=3, help='timing repetitions (best is kept)')
+
+    run = subparsers.add_parser('run', help='parse and write rates for each format')
+    run.add_argument('formats', type=str, nargs='*', default=list(iterators), help='formats to run')
+    run.add_argument('--num', type=int, default=20_000, help='documents per synthetic file')
+    run.add_argument('--reps', type=int, default=3, help='timing repetitions (best is kept)')
+    run.add_argument('--output', type=str, default='bench_results.jsonl', help='results file to append to')
+
+    history = subparsers.add_parser('history', help='compare stored results across commits')
+    history.add_argument('formats', type=str, nargs='*', help='formats to show')
+    history.add_argument('--input', type=str, default='bench_results.jsonl', help='results file to read')
+    history.add_argument('--last', type=int, default=10, help='number of runs to show')
+
+    args = parser.parse_args()
+
+    if args.cmd == 'memory':
+        ok = check_memory(args.formats, args.num, args.tol)
+    elif args.cmd == 'gen1':
+        ok = bench_gen1(args.num, reps=args.reps)
+    elif args.cmd == 'run':
+        ok = len(bench_all(args.formats, args.num, args.reps, output=args.output)) > 0
+    elif args.cmd == 'history':
+        show_history(args.input, formats=args.formats, last=args.last)
+        ok = True
+    sys.exit(0 if ok else 1)
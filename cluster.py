@@ -1,158 +1,543 @@
 # name matching using locality-sensitive hashing (simhash)
 # these are mostly idempotent
 
-from itertools import chain, repeat
-from math import ceil
+from itertools import islice
 
+import os
 import re
+import json
+import time
 import sqlite3
 import numpy as np
 import pandas as pd
-import networkx as nx
-try:
-    from distance.cdistance import levenshtein
-except:
-    from distance import levenshtein
 
-import simhash as sh
-from standardize import standardize_weak, standardize_strong
+import pyximport
+pyximport.install()
+import levcore
 
-def unique_names(con):
+import simhash as sh
+from perf import start_stage, finish_stage
+from standardize import standardize_weak, standardize_strong, standardize_batch, version as std_version
+from parse_store import iter_parquet
+
+# which version of standardize.py each cache table (and name.std) was made with
+def stored_version(con, table):
+    con.execute('create table if not exists std_version (tab text primary key, version text)')
+    ret = con.execute('select version from std_version where tab=?', (table,)).fetchone()
+    return ret[0] if ret is not None else None
+
+def mark_version(con, table):
+    con.execute('insert or replace into std_version values (?,?)', (table, std_version))
+
+# standardized forms through a cache table (raw -> std) that outlives the stages, so
+# only strings never seen before get standardized, cleared when standardize.py changes
+def load_cache(con, table):
+    con.execute(f'create table if not exists {table} (raw text primary key, std text)')
+    if stored_version(con, table) != std_version:
+        if con.execute(f'select 1 from {table} limit 1').fetchone() is not None:
+            print(f'{table}: standardize.py changed, clearing cache')
+        con.execute(f'delete from {table}')
+        mark_version(con, table)
+    return dict(con.execute(f'select raw,std from {table}'))
+
+# entries past the first known were added since loading
+def save_cache(con, table, cache, known):
+    con.executemany(f'insert into {table} values (?,?)', islice(cache.items(), known, None))
+    print(f'{table}: {len(cache)-known} new strings standardized, {known} cached')
+
+def cached_standardize(con, table, values, func):
+    cache = load_cache(con, table)
+    known = len(cache)
+    std = standardize_batch(values, func, cache)
+    save_cache(con, table, cache, known)
+    return std
+
+def has_table(con, table):
+    return con.execute('select 1 from sqlite_master where type=\'table\' and name=?', (table,)).fetchone() is not None
+
+# strong forms are stored with the names, older databases get them added here and they are
+# redone if standardize.py changed since
+def add_std(con):
+    cols = [row[1] for row in con.execute('pragma table_info(name)')]
+    if 'std' not in cols or stored_version(con, 'name') != std_version:
+        if 'std' in cols:
+            print('standardize.py changed, redoing name.std')
+        names = pd.read_sql('select id,name from name', con)
+        names['std'] = cached_standardize(con, 'std_strong', names['name'], standardize_strong)
+        if 'std' not in cols:
+            con.execute('alter table name add column std text')
+        con.executemany('update name set std=? where id=?', zip(names['std'], names['id'].tolist()))
+        mark_version(con, 'name')
+        con.commit()
+
+# (key, appname) frames of about chunksize rows from the db or parquet, empty names left out
+def iter_appnames(con, ptype, key, parquet=None, chunksize=100_000):
+    if parquet is not None:
+        yield from iter_parquet(parquet, ptype, columns=[key, 'appname'], filters=[('appname', '!=', '')], chunksize=chunksize)
+    else:
+        yield from pd.read_sql(f'select {key},appname from {ptype} where appname is not null and appname!=\'\'', con, chunksize=chunksize)
+
+# parquet is an optional dataset directory to read patents from instead of the db
+# the name table holds the weak form (name) and the strong one (std) of each distinct name
+# incremental keeps the existing names and their ids, new names are added with higher ids
+# patents are streamed chunksize rows at a time and their matches written as they go, so
+# only the distinct names (and their standardized forms) are ever held in memory
+def unique_names(con, parquet=None, incremental=False, chunksize=100_000):
     print('generating names')
 
-    apply = pd.read_sql('select appnum,appname from apply where appname is not null', con)
-    grant = pd.read_sql('select patnum,appname from grant where appname is not null', con)
-
-    apply = apply[apply['appname'].str.len()>0]
-    grant = grant[grant['appname'].str.len()>0]
-
-    apply['name'] = apply['appname'].apply(standardize_weak)
-    grant['name'] = grant['appname'].apply(standardize_weak)
-
-    names = pd.concat([apply['name'], grant['name']]).drop_duplicates().reset_index(drop=True)
-    names = names.rename('name').rename_axis('id').reset_index()
-    names.to_sql('name', con, index=False, if_exists='replace')
-
-    apply = pd.merge(apply, names, how='left', on='name')
-    grant = pd.merge(grant, names, how='left', on='name')
-
-    apply[['appnum', 'id']].to_sql('apply_match', con, index=False, if_exists='replace')
-    grant[['patnum', 'id']].to_sql('grant_match', con, index=False, if_exists='replace')
+    # distinct weak names to ids, starting from the existing ones
+    ids = {}
+    if incremental and has_table(con, 'name'):
+        add_std(con)
+        ids = dict(con.execute('select name,id from name order by id'))
+    nold = len(ids)
+    start = next_id = max(ids.values()) + 1 if nold > 0 else 0
+
+    weak = load_cache(con, 'std_weak')
+    known = len(weak)
+
+    for ptype, key in [('apply', 'appnum'), ('grant', 'patnum')]:
+        match = pd.DataFrame({key: [], 'id': []}).astype({key: object, 'id': int})
+        match.to_sql(f'{ptype}_match', con, index=False, if_exists='replace')
+        nrows = 0
+        for pats in iter_appnames(con, ptype, key, parquet=parquet, chunksize=chunksize):
+            names = standardize_batch(pats['appname'].tolist(), standardize_weak, weak)
+            for name in names:
+                if name not in ids:
+                    ids[name] = next_id
+                    next_id += 1
+            match = pd.DataFrame({key: pats[key], 'id': [ids[name] for name in names]})
+            match.to_sql(f'{ptype}_match', con, index=False, if_exists='append')
+            nrows += len(match)
+        print(f'{ptype}: {nrows} patents')
+
+    save_cache(con, 'std_weak', weak, known)
+    del weak
+
+    # ids were handed out in order, so the new names are the last ones
+    names = pd.DataFrame({'id': np.arange(start, next_id), 'name': list(islice(ids, nold, None))})
+    names['std'] = cached_standardize(con, 'std_strong', names['name'], standardize_strong)
+    names.to_sql('name', con, index=False, if_exists='append' if incremental else 'replace')
+    mark_version(con, 'name')
 
     con.commit()
-    print(f'found {len(names)} names')
+    if incremental:
+        print(f'{len(names)} new names')
+    print(f'found {len(ids)} names')
 
 # k = 8, thresh = 4 works well
-def filter_pairs(con, nshingle=2, k=8, thresh=4):
+# buckets over cap members overflow (split keeps every pair, skip drops them), pairs are
+# written out in batches as they are found and per bucket comparisons go to the bucket table
+# maxdist drops pairs whose signatures are further apart, store_dist keeps the distance in pair
+# with radius, pairs are instead all those within that hamming distance (permutation tables)
+# signatures are kept in the sign table and the index settings in sign_index, so incremental
+# only signs names added since and only makes pairs involving them (the index arrays are
+# just sorted signatures, rebuilding them is cheap), falling back to a full run if the stored
+# signatures don't match the names or the settings changed
+def filter_pairs(con, nshingle=2, k=8, thresh=4, cap=None, overflow='split', maxdist=None, store_dist=False, radius=None, batch=100_000, incremental=False):
     print('filtering pairs')
 
-    c = sh.Cluster(k=k, thresh=thresh)
-    name_dict = {}
-
-    names = pd.read_sql('select id,name from name', con)
-    for i, id, name in names.itertuples():
-        words = name.split()
-        shings = list(sh.shingle(name, nshingle))
-
-        features = shings + words
-        weights = list(np.linspace(1.0, 0.0, len(shings))) + list(np.linspace(1.0, 0.0, len(words)))
-
-        c.add(features, weights=weights, label=id)
-        name_dict[id] = name
-
-        if i > 0 and i % 100_000 == 0:
-            print(f'{i}: {len(c.unions)}')
-
-    pairs = pd.DataFrame([(i1, i2, name_dict[i1], name_dict[i2]) for i1, i2 in c.unions], columns=['id1', 'id2', 'name1', 'name2'])
-    pairs.to_sql('pair', con, index=False, if_exists='replace')
+    names = pd.read_sql('select id,name from name order by id', con)
+    params = (nshingle, k, thresh, cap, overflow, maxdist, int(store_dist), radius)
+
+    # stored signatures when they are still good, new names after them
+    known = pd.DataFrame({'id': [], 'sign': []}, dtype=np.int64)
+    if incremental and has_table(con, 'sign') and has_table(con, 'sign_index'):
+        if con.execute('select nshingle,k,thresh,cap,overflow,maxdist,store_dist,radius from sign_index').fetchone() == params:
+            known = pd.read_sql('select sign.id,sign.sign from sign join name on sign.id=name.id and sign.name=name.name order by sign.id', con)
+            nsign, = con.execute('select count(*) from sign').fetchone()
+            if len(known) < nsign or (len(known) > 0 and names['id'][~names['id'].isin(known['id'])].min() < known['id'].max()):
+                print('stored signatures are out of date, signing everything')
+                known = known.iloc[:0]
+        else:
+            print('index settings changed, signing everything')
+    since = len(known)
+    new = names[~names['id'].isin(known['id'])]
+
+    # sign new names a chunk at a time
+    signs = sh.simhash_names(new['name'], nshingle)
+    print(f'{len(new)} names signed, {since} stored')
+
+    # band matches from sorted arrays, or everything within radius
+    if radius is None:
+        index = sh.BandIndex(k=k, thresh=thresh, cap=cap, overflow=overflow, maxdist=maxdist)
+    else:
+        index = sh.PermIndex(radius=radius)
+    index.add(np.concatenate([known['sign'].to_numpy(np.int64).view(np.uint64), signs]), np.concatenate([known['id'], new['id']]))
+    name_dict = names.set_index('id')['name']
+
+    # pairs involving new names point from the new one, and any from an interrupted run go first
+    npairs = 0
+    cols = ['id1', 'id2', 'name1', 'name2'] + (['dist'] if store_dist else [])
+    if since > 0 and has_table(con, 'pair'):
+        if len(new) > 0:
+            con.execute('delete from pair where id1>=?', (int(new['id'].min()),))
+    else:
+        pairs = pd.DataFrame({'id1': [], 'id2': [], 'name1': [], 'name2': [], 'dist': []}).astype({'id1': int, 'id2': int, 'name1': object, 'name2': object, 'dist': int})
+        pairs[cols].to_sql('pair', con, index=False, if_exists='replace')
+    for id1, id2, dist in index.iter_pairs(batch=batch, since=since):
+        pairs = pd.DataFrame({'id1': id1, 'id2': id2, 'name1': name_dict.loc[id1].values, 'name2': name_dict.loc[id2].values, 'dist': dist})
+        pairs[cols].to_sql('pair', con, index=False, if_exists='append')
+        con.commit()
+        npairs += len(pairs)
+        print(f'{npairs} pairs')
+
+    if radius is None:
+        buckets = pd.DataFrame(index.bucket_stats())
+        buckets.to_sql('bucket', con, index=False, if_exists='replace')
+        over = buckets['status'] != 'done'
+        print(f'{buckets["comparisons"].sum()} comparisons, {over.sum()} buckets over cap')
+        if maxdist is not None:
+            print(f'{index.ndropped} of {index.nbanded} banded pairs over distance {maxdist}')
+
+    # signatures last, so names only count as done once their pairs are in
+    # (batch rows at a time, to_sql converts the whole frame to python objects first)
+    signed = pd.DataFrame({'id': new['id'], 'name': new['name'], 'sign': signs.view(np.int64)})
+    if since == 0:
+        signed.iloc[:0].to_sql('sign', con, index=False, if_exists='replace')
+    for i in range(0, len(signed), batch):
+        signed.iloc[i:i+batch].to_sql('sign', con, index=False, if_exists='append')
+    # since is how many stored signatures were kept, 0 means every pair was redone
+    con.execute('drop table if exists sign_index')
+    con.execute('create table sign_index (nshingle int, k int, thresh int, cap int, overflow text, maxdist int, store_dist int, radius int, since int)')
+    con.execute('insert into sign_index values (?,?,?,?,?,?,?,?,?)', params + (since,))
 
     con.commit()
-    print(f'found {len(pairs)} pairs')
-
-# compute distances on owners in same cluster
-def find_groups(con, thresh=0.85):
+    print(f'found {npairs} pairs')
+
+# character counts per name in 64 buckets (letters, digits, space, the rest hashed), capped at 255
+# merging characters into buckets or capping counts can only loosen the bound below, never break it
+def char_hist(names):
+    table = np.full(128, 37, dtype=np.int64)
+    table[ord('a'):ord('z')+1] = np.arange(26)
+    table[ord('0'):ord('9')+1] = 26 + np.arange(10)
+    table[ord(' ')] = 36
+
+    codes = np.frombuffer(''.join(names).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+    bucket = np.where(codes < 128, table[np.minimum(codes, 127)], 37 + codes % 27)
+    owner = np.repeat(np.arange(len(names)), [len(n) for n in names])
+    counts = np.bincount(owner*64 + bucket, minlength=len(names)*64).reshape(-1, 64)
+    return np.minimum(counts, 255).astype(np.uint8)
+
+# pairs (positions into names) whose similarity 1 - ldist/max_len could still be above thresh,
+# using lower bounds on the edit distance: the length difference, then characters that can't
+# be matched up (each edit fixes at most one surplus on either side)
+def prefilter(names, pos1, pos2, thresh, chunk=1_000_000):
+    lens = np.array([len(n) for n in names], dtype=np.int64)
+    len1, len2 = lens[pos1], lens[pos2]
+    max_len = np.maximum(len1, len2)
+
+    # same arithmetic as the exact metric, so a bound can't round its way past thresh
+    def possible(bound, max_len):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (max_len > 0) & (1.0 - bound/max_len > thresh)
+
+    keep_len = possible(np.abs(len1 - len2), max_len)
+
+    hist = char_hist(names)
+    keep = keep_len.copy()
+    for i0 in range(0, len(pos1), chunk):
+        idx = np.flatnonzero(keep_len[i0:i0+chunk]) + i0
+        diff = hist[pos1[idx]].astype(np.int16) - hist[pos2[idx]]
+        bound = np.maximum(np.maximum(diff, 0).sum(axis=1), np.maximum(-diff, 0).sum(axis=1))
+        keep[idx] = possible(bound, max_len[idx])
+
+    counts = {'length': int((~keep_len).sum()), 'histogram': int((keep_len & ~keep).sum())}
+    return keep, counts
+
+# code points of all names in one array, name i is chars[offsets[i]:offsets[i+1]]
+def encode_names(names):
+    chars = np.frombuffer(''.join(names).encode('utf-32-le'), dtype=np.uint32)
+    offsets = np.zeros(len(names)+1, dtype=np.int64)
+    np.cumsum([len(n) for n in names], out=offsets[1:])
+    return chars, offsets
+
+# connected components of the graph with edges id1[i]-id2[i], by union-find on arrays: hook
+# each edge's larger root onto the smaller one, then jump pointers until every node points at
+# its root, repeat until no edge spans two roots. returns the nodes and their component numbers,
+# largest component first and ties in order of first appearance in the edges (as networkx did)
+def components(id1, id2):
+    flat = np.column_stack([id1, id2]).ravel()
+    nodes, first, inv = np.unique(flat, return_index=True, return_inverse=True)
+    u, v = inv[0::2], inv[1::2]
+
+    parent = np.arange(len(nodes))
+    while True:
+        pu, pv = parent[u], parent[v]
+        span = pu != pv
+        if not span.any():
+            break
+        np.minimum.at(parent, np.maximum(pu[span], pv[span]), np.minimum(pu[span], pv[span]))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+    roots, root = np.unique(parent, return_inverse=True)
+    size = np.bincount(root)
+    start = np.full(len(roots), len(flat))
+    np.minimum.at(start, root, first)
+    rank = np.empty(len(roots), dtype=np.int64)
+    rank[np.lexsort((start, -size))] = np.arange(len(roots))
+    return nodes, rank[root]
+
+# new close pairs folded into the existing match table: a new name joins whatever firm it is
+# linked to, new groups linked to no existing firm are numbered after the existing ones (largest
+# first), and the odd new name bridging two existing firms merges them into the smaller number.
+# nothing else is renumbered. old names not in match are singleton firms id + base
+def merge_groups(con, close1, close2, since, base=1_000_000):
+    # rows for new names from an interrupted run go first, merges it made are kept and agree
+    con.execute('delete from match where id>=?', (since,))
+    match = pd.read_sql('select firm_num,id from match', con)
+    firm_of = pd.Series(match['firm_num'].to_numpy(), index=match['id'])
+
+    # old names stand in as their firm, numbered -1 - firm_num so they can't collide with ids
+    def node(ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        old = ids < since
+        firm = firm_of.reindex(ids[old]).to_numpy(dtype=np.float64, na_value=np.nan)
+        firm = np.where(np.isnan(firm), ids[old] + base, firm).astype(np.int64)
+        out = ids.copy()
+        out[old] = -1 - firm
+        return out
+    nodes, comp = components(node(close1), node(close2))
+    ncomp = comp.max() + 1 if len(comp) > 0 else 0
+
+    # smallest existing firm in each component, otherwise a fresh number in component order
+    isold = nodes < 0
+    firm = -1 - nodes[isold]
+    target = np.full(ncomp, np.iinfo(np.int64).max)
+    np.minimum.at(target, comp[isold], firm)
+    fresh = target == np.iinfo(np.int64).max
+    grouped = match['firm_num'][match['firm_num'] < base]
+    target[fresh] = (grouped.max() + 1 if len(grouped) > 0 else 0) + np.arange(fresh.sum())
+
+    # new names, then existing firms taken over by another one (singletons join as members)
+    cur = con.cursor()
+    rows = zip(target[comp[~isold]].tolist(), nodes[~isold].tolist())
+    cur.executemany('insert into match (firm_num,id) values (?,?)', rows)
+    moved = firm != target[comp[isold]]
+    ingroup = np.isin(firm, match['firm_num'])
+    cur.executemany('update match set firm_num=? where firm_num=?', zip(target[comp[isold]][moved & ingroup].tolist(), firm[moved & ingroup].tolist()))
+    cur.executemany('insert into match (firm_num,id) values (?,?)', zip(target[comp[isold]][~ingroup].tolist(), (firm[~ingroup] - base).tolist()))
+
+    print(f'{(~isold).sum()} new names grouped: {fresh.sum()} new groups, {(~fresh).sum()} joined existing firms, {moved.sum()} existing firms merged into others')
+
+# whether the last filter_pairs redid every pair rather than adding those of new names, in which
+# case old names may have gained or lost pairs among themselves and only a full regroup is right
+def pairs_rebuilt(con):
+    if not has_table(con, 'sign_index'):
+        return True
+    if 'since' not in [c[1] for c in con.execute('pragma table_info(sign_index)')]:
+        return True
+    row = con.execute('select since from sign_index').fetchone()
+    return row is None or row[0] == 0
+
+# similarity is 1 - levenshtein/max_len, computed a chunk of pairs at a time over nthreads (default all cores)
+# incremental only checks pairs involving names added since the last merge_firms and folds
+# them into the existing groups (see merge_groups), otherwise groups are rebuilt from scratch
+def find_groups(con, thresh=0.85, chunk=1_000_000, nthreads=0, incremental=False, base=1_000_000):
     print('finding matches')
 
-    def dmetr(name1, name2):
-        max_len = max(len(name1), len(name2))
-        max_dist = int(ceil(max_len*(1.0-thresh)))
-        ldist = levenshtein(name1, name2, max_dist=max_dist)
-        return (1.0 - float(ldist)/max_len) if (ldist != -1 and max_len != 0) else 0.0
-
-    dists = []
-    close = []
-    name_dict = {}
-    name_std = {}
-
-    pairs = pd.read_sql('select id1,id2,name1,name2 from pair', con)
-    for i, id1, id2, name1, name2 in pairs.itertuples():
-        if id1 not in name_dict:
-            n1std = standardize_strong(name1)
-            name_dict[id1] = name1
-            name_std[id1] = n1std
+    since = None
+    if incremental and has_table(con, 'firm') and has_table(con, 'match'):
+        if pairs_rebuilt(con):
+            print('pairs were all redone, grouping everything')
         else:
-            n1std = name_std[id1]
-        if id2 not in name_dict:
-            n2std = standardize_strong(name2)
-            name_dict[id2] = name2
-            name_std[id2] = n2std
-        else:
-            n2std = name_std[id2]
-
-        d = dmetr(n1std, n2std)
-
-        dists.append((id1, id2, d))
-        if d > thresh:
-            close.append((id1, id2))
-
-        if i > 0 and i % 100_000 == 0:
-            print(f'{i}: {len(close)}')
-
-    G = nx.Graph()
-    G.add_edges_from(close)
-    comps = sorted(nx.connected_components(G), key=len, reverse=True)
-
-    cmap = pd.DataFrame(chain(*[zip(repeat(fid), ids) for fid, ids in enumerate(comps)]), columns=['firm_num', 'id'])
+            since, = con.execute('select max(id)+1 from firm').fetchone()
+    if since is not None:
+        pairs = pd.read_sql('select id1,id2 from pair where id1>=?', con, params=(since,))
+    else:
+        pairs = pd.read_sql('select id1,id2 from pair', con)
+
+    add_std(con)
+    names = pd.read_sql('select id,std from name', con)
+    names = names[names['id'].isin(pairs['id1']) | names['id'].isin(pairs['id2'])]
+
+    ids = pd.Index(names['id'])
+    std = names['std'].tolist()
+    pos1 = ids.get_indexer(pairs['id1'])
+    pos2 = ids.get_indexer(pairs['id2'])
+
+    # cheap bounds first, only survivors get the exact metric
+    keep, counts = prefilter(std, pos1, pos2, thresh)
+    print(f'{len(pairs)} pairs: {counts["length"]} ruled out by length, {counts["histogram"]} by characters, {keep.sum()} left')
+
+    chars, offsets = encode_names(std)
+    pos1, pos2 = pos1[keep].astype(np.int64), pos2[keep].astype(np.int64)
+
+    close1, close2 = [], []
+    for i in range(0, len(pos1), chunk):
+        sims = levcore.levsim_batch(chars, offsets, pos1[i:i+chunk], pos2[i:i+chunk], thresh, nthreads)
+        hit = sims > thresh
+        close1.append(ids[pos1[i:i+chunk][hit]])
+        close2.append(ids[pos2[i:i+chunk][hit]])
+        print(f'{i+len(sims)}: {sum(map(len, close1))}')
+
+    close1 = np.concatenate(close1) if close1 else np.zeros(0, dtype=np.int64)
+    close2 = np.concatenate(close2) if close2 else np.zeros(0, dtype=np.int64)
+
+    if since is not None:
+        merge_groups(con, close1, close2, since, base=base)
+        con.commit()
+        return
+
+    nodes, firm_num = components(close1, close2)
+
+    cmap = pd.DataFrame({'firm_num': firm_num, 'id': nodes}).sort_values(['firm_num', 'id'])
     cmap.to_sql('match', con, index=False, if_exists='replace')
 
     con.commit()
-    print(f'found {len(comps)} groups')
+    print(f'found {firm_num.max()+1 if len(firm_num) else 0} groups')
 
 # must be less than 1000000 components
+# names not in a group are their own firm, id + base, everything is done inside sqlite and
+# indexed on firm_num and the patent numbers so firm level lookups don't need scans
 def merge_firms(con, base=1_000_000):
     print('merging firms')
 
-    names = pd.read_sql('select * from name', con)
-    match = pd.read_sql('select * from match', con)
-    firms = pd.merge(names, match, how='left', on='id')
-    firms['firm_num'] = firms['firm_num'].fillna(firms['id']+base).astype(np.int)
-    firms[['firm_num', 'id']].to_sql('firm', con, index=False, if_exists='replace')
-
-    apply = pd.read_sql('select * from apply_match', con)
-    grant = pd.read_sql('select * from grant_match', con)
+    cur = con.cursor()
+    cur.execute('create index if not exists idx_match_id on match (id)')
 
-    apply = pd.merge(apply, firms, on='id')
-    grant = pd.merge(grant, firms, on='id')
+    cur.execute('drop table if exists firm')
+    cur.execute('create table firm (firm_num int, id int)')
+    cur.execute('insert into firm select coalesce(match.firm_num, name.id+?),name.id from name left join match on name.id=match.id', (base,))
+    cur.execute('create unique index idx_firm_id on firm (id)')
+    cur.execute('create index idx_firm_num on firm (firm_num)')
 
-    apply[['appnum', 'firm_num']].to_sql('apply_firm', con, index=False, if_exists='replace')
-    grant[['patnum', 'firm_num']].to_sql('grant_firm', con, index=False, if_exists='replace')
+    for ptype, key in [('apply', 'appnum'), ('grant', 'patnum')]:
+        cur.execute(f'drop table if exists {ptype}_firm')
+        cur.execute(f'create table {ptype}_firm ({key} text, firm_num int)')
+        cur.execute(f'insert into {ptype}_firm select {ptype}_match.{key},firm.firm_num from {ptype}_match join firm on {ptype}_match.id=firm.id')
+        cur.execute(f'create index idx_{ptype}_firm_{key} on {ptype}_firm ({key})')
+        cur.execute(f'create index idx_{ptype}_firm_num on {ptype}_firm (firm_num)')
 
     con.commit()
+    nfirm, = cur.execute('select count(distinct firm_num) from firm').fetchone()
+    print(f'found {nfirm} firms')
 
 def get_groups(con):
     return pd.read_sql('select * from match join name on match.id=name.id order by firm_num', con)
 
+##
+## stage checkpoints
+##
+
+# one row per stage with fingerprints of its inputs and outputs, status goes started -> complete
+def init_stages(con):
+    con.execute('create table if not exists stage (stage text primary key, inputs text, outputs text, status text, finished text)')
+
+# row count and largest rowid of each table (None if missing), parquet datasets by their files
+# the standardize.py version goes in too, since names and their std forms depend on it
+def fingerprint(con, tables, parquet=None, **params):
+    state = {}
+    for table in tables:
+        if parquet is not None and table in ('apply', 'grant'):
+            files = [os.path.join(d, f) for d, _, fs in os.walk(os.path.join(parquet, table)) for f in fs]
+            state[table] = sorted((os.path.relpath(f, parquet), os.path.getsize(f), int(os.path.getmtime(f))) for f in files)
+        elif has_table(con, table):
+            state[table] = con.execute(f'select count(*),max(rowid) from {table}').fetchone()
+        else:
+            state[table] = None
+    return json.dumps({'tables': state, 'params': params, 'standardize': std_version}, sort_keys=True)
+
+# only skip if the stage finished on the same inputs and its outputs haven't been touched since
+def stage_current(con, stage, inputs, outputs):
+    ret = con.execute('select inputs,outputs,status from stage where stage=?', (stage,)).fetchone()
+    return ret is not None and ret == (inputs, fingerprint(con, outputs), 'complete')
+
+# the tables whose rows perf_log gives as each stage's rows in and out, patents being apply plus grant
+stage_rows = {
+    'unique_names': (['apply', 'grant'], ['name']),
+    'filter_pairs': (['name'], ['pair']),
+    'find_groups': (['pair'], ['match']),
+    'merge_firms': (['apply_match', 'grant_match'], ['apply_firm', 'grant_firm']),
+}
+
+# total rows of these db tables in a fingerprint (None if there are none, like parquet inputs)
+def fingerprint_rows(fprint, tables):
+    state = json.loads(fprint)['tables']
+    counts = [state[t][0] for t in tables if state.get(t) and isinstance(state[t][0], int)]
+    return sum(counts) if len(counts) > 0 else None
+
+def mark_stage(con, stage, inputs, status, outputs=None):
+    finished = time.strftime('%Y-%m-%d %H:%M:%S') if status == 'complete' else None
+    con.execute('insert or replace into stage values (?,?,?,?,?)', (stage, inputs, outputs, status, finished))
+    con.commit()
+
+# stages in order as (name, function, keyword args, input tables, output tables), a stage runs
+# if it isn't current, if it is from_stage or later, or if anything before it ran this time
+# each run goes to perf_log with the rows of its stage_rows tables, profile is None,
+# cprofile or sample for a dump per stage in profile_dir
+def run_stages(con, steps, from_stage=None, profile=None, profile_dir='perf'):
+    init_stages(con)
+    names = [name for name, _, _, _, _ in steps]
+    start = names.index(from_stage) if from_stage is not None else len(names)
+    ran = False
+    for i, (name, func, kwargs, ins, outs) in enumerate(steps):
+        params = {k: v for k, v in kwargs.items() if k != 'parquet'}
+        inputs = fingerprint(con, ins, parquet=kwargs.get('parquet'), **params)
+        if not ran and i < start and stage_current(con, name, inputs, outs):
+            print(f'skipping {name}, inputs unchanged')
+            continue
+        mark_stage(con, name, inputs, 'started')
+        perf = start_stage(name, profile=profile)
+        func(con, **kwargs)
+        outputs = fingerprint(con, outs)
+        rows_in, rows_out = stage_rows.get(name, ([], []))
+        finish_stage(con, perf, rows_in=fingerprint_rows(inputs, rows_in), rows_out=fingerprint_rows(outputs, rows_out), profile_dir=profile_dir)
+        # inputs again, since a stage can write tables it reads (sign in incremental filter_pairs)
+        mark_stage(con, name, fingerprint(con, ins, parquet=kwargs.get('parquet'), **params), 'complete', outputs)
+        ran = True
+
+    # later stages write tables earlier ones read (merge_firms makes the firm table incremental
+    # find_groups starts from), so once they all ran those are taken as the inputs they were
+    # current on, or every run would start over at the earliest such stage
+    for name, func, kwargs, ins, outs in steps:
+        params = {k: v for k, v in kwargs.items() if k != 'parquet'}
+        inputs = fingerprint(con, ins, parquet=kwargs.get('parquet'), **params)
+        con.execute('update stage set inputs=?, outputs=? where stage=? and status=?', (inputs, fingerprint(con, outs), name, 'complete'))
+    con.commit()
+
+stages = ['unique_names', 'filter_pairs', 'find_groups', 'merge_firms']
+
 if __name__ == "__main__":
     import argparse
 
     # parse input arguments
     parser = argparse.ArgumentParser(description='Create firm name clusters.')
     parser.add_argument('--db', type=str, default=None, help='database file to store to')
+    parser.add_argument('--parquet', type=str, default=None, help='read patents from parquet datasets in this directory')
+    parser.add_argument('--nshingle', type=int, default=2, help='characters per shingle in the signatures')
+    parser.add_argument('--k', type=int, default=8, help='number of signature bands')
+    parser.add_argument('--thresh', type=int, default=4, help='bands a pair must share (more than)')
+    parser.add_argument('--cap', type=int, default=None, help='largest band bucket to compare directly')
+    parser.add_argument('--overflow', type=str, default='split', help='what to do with bigger buckets: split or skip')
+    parser.add_argument('--maxdist', type=int, default=None, help='largest signature hamming distance to keep')
+    parser.add_argument('--store-dist', action='store_true', help='keep signature distances in the pair table')
+    parser.add_argument('--radius', type=int, default=None, help='pair all names within this signature distance instead of banding')
+    parser.add_argument('--similarity', type=float, default=0.85, help='edit distance similarity needed to match names')
+    parser.add_argument('--incremental', action='store_true', help='only add names not seen before, keeping existing firm numbers')
+    parser.add_argument('--from-stage', type=str, default=None, choices=stages, help='rerun from this stage on even if inputs are unchanged')
+    parser.add_argument('--profile', type=str, default=None, choices=['cprofile', 'sample'], help='dump a profile of each stage')
+    parser.add_argument('--profile-dir', type=str, default='perf', help='directory for profile dumps')
     args = parser.parse_args()
 
-    # go through steps
+    # incremental stages also read what the last run left behind
+    inc = args.incremental
+    steps = [
+        ('unique_names', unique_names, {'parquet': args.parquet, 'incremental': inc},
+            ['apply', 'grant'] + (['name'] if inc else []), ['name', 'apply_match', 'grant_match']),
+        ('filter_pairs', filter_pairs, {'nshingle': args.nshingle, 'k': args.k, 'thresh': args.thresh, 'cap': args.cap, 'overflow': args.overflow,
+            'maxdist': args.maxdist, 'store_dist': args.store_dist, 'radius': args.radius, 'incremental': inc},
+            ['name'] + (['sign', 'sign_index'] if inc else []), ['pair', 'sign', 'sign_index', 'bucket']),
+        ('find_groups', find_groups, {'thresh': args.similarity, 'incremental': inc},
+            ['name', 'pair'] + (['firm', 'match', 'sign_index'] if inc else []), ['match']),
+        ('merge_firms', merge_firms, {},
+            ['name', 'match', 'apply_match', 'grant_match'], ['firm', 'apply_firm', 'grant_firm']),
+    ]
+
+    # go through steps, skipping those already done on the same inputs
     with sqlite3.connect(args.db) as con:
-        unique_names(con)
-        filter_pairs(con)
-        find_groups(con)
-        merge_firms(con)
+        run_stages(con, steps, from_stage=args.from_stage, profile=args.profile, profile_dir=args.profile_dir)
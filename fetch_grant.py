@@ -34,8 +34,5 @@ for name, path, url in sorted(url_list):
     print()
     time.sleep(10)
 
-# to extract:
-# cd data/grant
-# ls | xargs -n 1 unzip
-# rm *.txt
-# rm *.html
+# no need to extract, the parsers stream straight out of the zip files:
+# python3 parse_all.py data/grant/*.zip
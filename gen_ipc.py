@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+# the parsers now write these tables as they go, this backfills databases loaded before that
+
 import argparse
 import sqlite3
 from mectools import db
 import mectools.hyper as hy
+from parse_store import iter_parquet
+from parse_tools import ipc_ranks
 
 parser = argparse.ArgumentParser(description='IPC code mapper.')
 parser.add_argument('--db', type=str, help='database file to store to')
 parser.add_argument('--clobber', action='store_true', help='delete old database')
 parser.add_argument('--ptype', type=str, default='apply', help='whether to do applications or grants')
 parser.add_argument('--chunk', type=int, default=100_000, help='chunk size to fetch')
+parser.add_argument('--parquet', type=str, default=None, help='read patents from parquet datasets in this directory')
+parser.add_argument('--years', type=str, default=None, help='only these publication years with parquet (e.g. 2001-2010)')
 args = parser.parse_args()
 
 # open db
@@ -29,18 +35,23 @@ if args.clobber:
 # ipc generator
 def gen_ipc(df):
     for i, (pn, vr, i1, i2) in df.iterrows():
-        r = 1
-        if i1 is not None and len(i1) > 0:
-            yield pn, vr, i1, r
-            r += 1
-        if i2 is not None and len(i2) > 0:
-            for i in i2.split(';'):
-                yield pn, vr, i, r
-                r += 1
+        for r, c in ipc_ranks(i1, i2):
+            yield pn, vr, c, r
+
+# input chunks, parquet only reads the needed columns and partitions
+columns = [patid, 'ipcver', 'ipc1', 'ipc2']
+if args.parquet is not None:
+    filters = None
+    if args.years is not None:
+        year0, year1 = args.years.split('-')
+        filters = [('year', '>=', year0), ('year', '<=', year1)]
+    chunks = iter_parquet(args.parquet, inp_table, columns=columns, filters=filters, chunksize=args.chunk)
+else:
+    chunks = con.table(inp_table, columns=columns, chunksize=args.chunk)
 
 # tools
 tot = 0
-for df in hy.progress(con.table(inp_table, columns=[patid, 'ipcver', 'ipc1', 'ipc2'], chunksize=args.chunk), per=1):
+for df in hy.progress(chunks, per=1):
     ipcs = gen_ipc(df)
     con.insert(out_table, ipcs, n=4)
 
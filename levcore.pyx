@@ -0,0 +1,84 @@
+# cython: boundscheck=False, wraparound=False
+# bounded levenshtein kernels, no module state so they can run from many threads at once
+
+import os
+import numpy as np
+from libc.stdint cimport uint32_t, int64_t
+from libc.stdlib cimport malloc, free
+from libc.math cimport ceil
+from cython.parallel cimport prange
+
+# edit distance between chars[a0:a0+la] and chars[b0:b0+lb], or max_dist + 1 as soon as it
+# has to be more than max_dist, row is scratch space for lb + 1 entries
+cdef Py_ssize_t bounded_lev(const uint32_t[:] chars, Py_ssize_t a0, Py_ssize_t la, Py_ssize_t b0, Py_ssize_t lb, Py_ssize_t max_dist, Py_ssize_t* row) noexcept nogil:
+    cdef Py_ssize_t i, j, diag, above, cost, rmin
+    cdef uint32_t ca
+
+    if la - lb > max_dist or lb - la > max_dist:
+        return max_dist + 1
+
+    for j in range(lb+1):
+        row[j] = j
+
+    for i in range(1, la+1):
+        diag = row[0]
+        row[0] = i
+        rmin = i
+        ca = chars[a0+i-1]
+        for j in range(1, lb+1):
+            above = row[j]
+            cost = diag + (ca != chars[b0+j-1])
+            if above + 1 < cost:
+                cost = above + 1
+            if row[j-1] + 1 < cost:
+                cost = row[j-1] + 1
+            diag = above
+            row[j] = cost
+            if cost < rmin:
+                rmin = cost
+        if rmin > max_dist:
+            return max_dist + 1
+
+    return row[lb]
+
+# 1 - dist/max_len like find_groups always used, zero if the distance is over ceil(max_len*(1-thresh))
+cdef double similarity(const uint32_t[:] chars, const int64_t[:] offsets, int64_t p1, int64_t p2, double thresh) noexcept nogil:
+    cdef Py_ssize_t a0 = offsets[p1], la = offsets[p1+1] - offsets[p1]
+    cdef Py_ssize_t b0 = offsets[p2], lb = offsets[p2+1] - offsets[p2]
+    cdef Py_ssize_t max_len = la if la > lb else lb
+    cdef Py_ssize_t max_dist, dist
+    cdef Py_ssize_t* row
+
+    if max_len == 0:
+        return 0.0
+
+    max_dist = <Py_ssize_t>ceil(max_len*(1.0-thresh))
+    row = <Py_ssize_t*>malloc((lb+1)*sizeof(Py_ssize_t))
+    if row == NULL:
+        return -1.0
+    dist = bounded_lev(chars, a0, la, b0, lb, max_dist, row)
+    free(row)
+
+    if dist > max_dist:
+        return 0.0
+    return 1.0 - (<double>dist)/max_len
+
+# names in csr layout (code points of name i are chars[offsets[i]:offsets[i+1]]), scores for
+# the pairs (pos1[k], pos2[k]) spread over nthreads (default all cores)
+def levsim_batch(const uint32_t[:] chars, const int64_t[:] offsets, const int64_t[:] pos1, const int64_t[:] pos2, double thresh, int nthreads=0):
+    cdef Py_ssize_t n = pos1.shape[0]
+    cdef Py_ssize_t k
+
+    scores = np.zeros(n, dtype=np.float64)
+    cdef double[:] out = scores
+
+    if nthreads <= 0:
+        nthreads = os.cpu_count() or 1
+
+    with nogil:
+        for k in prange(n, num_threads=nthreads, schedule='guided'):
+            out[k] = similarity(chars, offsets, pos1[k], pos2[k], thresh)
+
+    if n > 0 and scores.min() < 0:
+        raise MemoryError('out of memory in levsim_batch')
+    return scores
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# parse many grant/apply files in a process pool, writing from a single process
+
+import os
+import time
+import sqlite3
+import argparse
+from queue import Empty
+from collections import deque
+from multiprocessing import Pool, Queue
+
+import parse_grant
+import parse_apply
+from parse_store import init_manifest, file_stat, file_checksum, is_complete, mark_started, mark_complete, has_parquet, mark_parquet
+from parse_store import bulk_pragmas, init_stage, stage_cmd, stage_ipcs, merge_stage, write_parquet
+from parse_store import ipc_rows, write_ipcs
+from perf import start_stage, finish_stage
+
+# dispatch on file name
+def file_type(fname):
+    if fname.startswith('pab') or fname.startswith('ipab'):
+        return 'apply'
+    else:
+        return 'grant'
+
+parsers = {
+    'grant': parse_grant.iter_grants,
+    'apply': parse_apply.iter_applications,
+}
+
+inits = {
+    'grant': parse_grant.init_db,
+    'apply': parse_apply.init_db,
+}
+
+commands = {
+    'grant': parse_grant.insert_cmd,
+    'apply': parse_apply.insert_cmd,
+}
+
+columns = {
+    'grant': parse_grant.skeys,
+    'apply': parse_apply.skeys,
+}
+
+# for bulk mode
+stages = {
+    'grant': stage_cmd('grant', parse_grant.nkeys),
+    'apply': stage_cmd('apply', parse_apply.nkeys),
+}
+
+indices = {
+    'grant': ('patnum', 'idx_patnum'),
+    'apply': ('appnum', 'idx_appnum'),
+}
+
+# each worker gets the queues of all the window slots when it starts
+def init_worker(slots):
+    global queues
+    queues = slots
+
+# runs in worker: parse a file and ship rows back in batches through its slot's queue, along
+# with the ranked ipc rows of each patent, then the parse time and checksum for the manifest.
+# a full queue blocks the worker, that time isn't counted as parsing. parquet rows are kept
+# for the whole file since each file is written out in one go (here, if asked). with load
+# false only the parquet gets written, for files already in sqlite
+def parse_file(fpath, slot, load=True, batch=1000, parquet=None):
+    fname = os.path.basename(fpath)
+    ptype = file_type(fname)
+    key, _ = indices[ptype]
+    queue = queues[slot]
+
+    t0 = time.time()
+    twait = 0.0
+    def ship(rows, ipcs):
+        nonlocal twait
+        t1 = time.time()
+        queue.put(('rows', ptype, rows, ipcs))
+        twait += time.time() - t1
+
+    rows, ipcs, table = [], [], []
+    for p in parsers[ptype](fpath):
+        row = list(p.values())
+        if load:
+            rows.append(row)
+            ipcs.append((p[key], ipc_rows(p)))
+        if parquet is not None:
+            table.append(row)
+        if len(rows) >= batch:
+            ship(rows, ipcs)
+            rows, ipcs = [], []
+    if len(rows) > 0:
+        ship(rows, ipcs)
+    if parquet is not None:
+        write_parquet(table, columns[ptype], parquet, ptype, fname)
+    queue.put(('done', ptype, time.time() - t0 - twait, file_checksum(fpath) if load else None))
+
+# files go out to the pool at most one per slot and are read back in order, so at most
+# window files (and depth batches of each) are in flight and a slow writer makes the parsers
+# wait instead of piling up rows here. a worker that fails raises here through its result
+def stream_files(pool, slots, jobs, **kwargs):
+    pending = deque()
+    todo = iter(enumerate(jobs.items()))
+    def submit():
+        item = next(todo, None)
+        if item is not None:
+            i, (fpath, load) = item
+            slot = i % len(slots)
+            pending.append((fpath, slot, pool.apply_async(parse_file, (fpath, slot, load), kwargs)))
+
+    for _ in slots:
+        submit()
+    while len(pending) > 0:
+        fpath, slot, res = pending.popleft()
+        while True:
+            try:
+                msg = slots[slot].get(timeout=1)
+            except Empty:
+                if res.ready() and not res.successful():
+                    res.get()
+                continue
+            yield fpath, msg
+            if msg[0] == 'done':
+                break
+        submit()
+
+# rows are written in input order, so later files win on conflicts just like a serial run
+# bulk mode appends to unindexed stage tables and merges them in at the end
+# parquet is an optional directory to also write columnar datasets to
+# window is the number of files in flight (default twice the processes), depth the batches queued per file
+def parse_all(paths, db, nproc=None, chunk=1000, clobber=False, force=False, bulk=False, parquet=None, window=None, depth=4):
+    con = sqlite3.connect(db)
+    cur = con.cursor()
+    for ptype, init in inits.items():
+        init(cur, clobber=clobber)
+        init_manifest(cur, clobber=ptype if clobber else None)
+    if bulk:
+        bulk_pragmas(cur)
+        for ptype in inits:
+            init_stage(cur, ptype)
+
+    # only parse files that aren't already fully loaded, or are only missing their parquet
+    infos, jobs = {}, {}
+    for fpath in paths:
+        info = file_stat(fpath)
+        if not force and is_complete(cur, info, fpath):
+            if parquet is None or has_parquet(cur, info, parquet):
+                print(f'{info[0]}: already loaded')
+                continue
+            jobs[fpath] = False
+        else:
+            mark_started(cur, info, file_type(info[0]))
+            jobs[fpath] = True
+        infos[fpath] = info
+    con.commit()
+
+    nproc = nproc or os.cpu_count()
+    slots = [Queue(depth) for _ in range(window or 2*nproc)]
+
+    tot = 0
+    done = []
+    counts = {fpath: 0 for fpath in infos}
+    staged = {ptype: 0 for ptype in inits}
+    twrite = 0.0
+    t0 = time.time()
+    with Pool(nproc, initializer=init_worker, initargs=(slots,)) as pool:
+        for fpath, msg in stream_files(pool, slots, jobs, batch=chunk, parquet=parquet):
+            t1 = time.time()
+            if msg[0] == 'rows':
+                _, ptype, rows, ipcs = msg
+                key, _ = indices[ptype]
+                if bulk:
+                    cur.executemany(stages[ptype], rows)
+                    stage_ipcs(cur, ptype, staged[ptype] + 1, ipcs)
+                else:
+                    cur.executemany(commands[ptype], rows)
+                    write_ipcs(cur, ptype, key, ipcs)
+                con.commit()
+                staged[ptype] += len(rows)
+                counts[fpath] += len(rows)
+                tot += len(rows)
+            else:
+                _, ptype, ptime, checksum = msg
+                n = counts[fpath]
+                if parquet is not None:
+                    mark_parquet(cur, infos[fpath], parquet)
+                if not jobs[fpath]:
+                    print(f'{infos[fpath][0]}: already loaded, wrote parquet')
+                elif bulk:
+                    done.append((infos[fpath], checksum, n, ptime))
+                else:
+                    mark_complete(cur, infos[fpath], checksum, n, ptime)
+                con.commit()
+                if jobs[fpath]:
+                    print(f'{infos[fpath][0]}: {n} patents ({tot/(time.time()-t0):.0f}/s)')
+            twrite += time.time() - t1
+
+    # files only count as loaded once their rows are in the real tables, so both swaps and
+    # the manifest updates go in one transaction
+    if bulk:
+        t1 = time.time()
+        con.commit()
+        cur.execute('begin')
+        for ptype, (key, index) in indices.items():
+            size = merge_stage(con, ptype, key, index)
+            print(f'merged {ptype}: {size} rows')
+        for info, checksum, n, ptime in done:
+            mark_complete(cur, info, checksum, n, ptime)
+        con.commit()
+        print(f'merge took {time.time()-t1:.1f}s')
+        twrite += time.time() - t1
+
+    # writing is the serial part, so that's the rate to compare across modes
+    tall = time.time() - t0
+    print(f'loaded {tot} rows in {tall:.1f}s ({tot/tall:.0f} rows/s), writing took {twrite:.1f}s ({tot/max(twrite, 1e-9):.0f} rows/s)')
+
+    cur.close()
+    con.close()
+
+    return tot
+
+if __name__ == '__main__':
+    # parse input arguments
+    parser = argparse.ArgumentParser(description='parallel patent parser')
+    parser.add_argument('paths', type=str, nargs='+', help='paths of files to parse')
+    parser.add_argument('--db', type=str, default='store/patents.db', help='database file to store to')
+    parser.add_argument('--clobber', action='store_true', help='delete database and restart')
+    parser.add_argument('--nproc', type=int, default=None, help='number of parser processes (default all cores)')
+    parser.add_argument('--chunk', type=int, default=1000, help='chunk insert size (and batch size shipped from the parsers)')
+    parser.add_argument('--window', type=int, default=None, help='files in flight at once (default twice the processes)')
+    parser.add_argument('--force', action='store_true', help='parse even if already loaded')
+    parser.add_argument('--bulk', action='store_true', help='stage unindexed and merge at the end')
+    parser.add_argument('--parquet', type=str, default=None, help='also write parquet datasets to this directory')
+    parser.add_argument('--profile', type=str, default=None, choices=['cprofile', 'sample'], help='dump a profile of the run (this process, not the parsers)')
+    parser.add_argument('--profile-dir', type=str, default='perf', help='directory for profile dumps')
+    args = parser.parse_args()
+
+    # cpu time includes the parser processes, memory is this one (where rows are written from)
+    perf = start_stage('parse_all', profile=args.profile)
+    tot = parse_all(args.paths, args.db, nproc=args.nproc, chunk=args.chunk, clobber=args.clobber, force=args.force, bulk=args.bulk, parquet=args.parquet, window=args.window)
+    with sqlite3.connect(args.db) as con:
+        finish_stage(con, perf, rows_in=tot, rows_out=tot, profile_dir=args.profile_dir)
+    print(f'Found {tot} patents')
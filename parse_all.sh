@@ -1,7 +1,10 @@
 #!/usr/bin/env bash
 
-ls data/grant/*.dat | sort | xargs -n 1 python3 parse_grant.py
-ls data/grant/pgb*.xml | sort | xargs -n 1 python3 parse_grant.py
-ls data/grant/ipgb*.xml | sort | xargs -n 1 python3 parse_grant.py
-ls data/apply/pab*.xml | sort | xargs -n 1 python3 parse_apply.py
-ls data/apply/ipab*.xml | sort | xargs -n 1 python3 parse_apply.py
+# parses in parallel across all cores, files are written in the order given
+# zip archives are read directly, no need to unzip
+python3 parse_all.py \
+    $(ls data/grant/[0-9]*.zip | sort) \
+    $(ls data/grant/pgb*.zip | sort) \
+    $(ls data/grant/ipgb*.zip | sort) \
+    $(ls data/apply/pab*.zip | sort) \
+    $(ls data/apply/ipab*.zip | sort)
@@ -4,7 +4,8 @@
 import re
 import os
 import sys
-import argparse
+import time
+import mmap
 import sqlite3
 from lxml.etree import iterparse, tostring, XMLPullParser
 from copy import copy
@@ -12,30 +13,8 @@ from collections import OrderedDict
 from itertools import chain
 
 from parse_tools import *
-
-# parse input arguments
-parser = argparse.ArgumentParser(description='patent grant parser')
-parser.add_argument('path', type=str, help='path of file to parse')
-parser.add_argument('--db', type=str, default='store/patents.db', help='database file to store to')
-parser.add_argument('--clobber', action='store_true', help='delete database and restart')
-parser.add_argument('--output', type=int, default=0, help='print out patents per')
-parser.add_argument('--limit', type=int, default=0, help='only parse n patents')
-parser.add_argument('--chunk', type=int, default=1000, help='chunk insert size')
-args = parser.parse_args()
-
-# for later
-write = args.db is not None
-
-# detect generation
-(fdir, fname) = os.path.split(args.path)
-if fname.endswith('.dat'):
-    gen = 1
-elif fname.startswith('pgb'):
-    gen = 2
-elif fname.startswith('ipgb'):
-    gen = 3
-else:
-    raise Exception('Unknown format')
+from parse_store import init_manifest, file_stat, file_checksum, is_complete, mark_started, mark_complete, has_parquet, mark_parquet, write_parquet
+from parse_store import init_ipc, ipc_rows, write_ipcs
 
 # us fields
 grant_keys = [
@@ -58,67 +37,45 @@ grant_keys = [
     'gen', # USPTO data format
 ]
 
-# default values
+# column order
 skeys = sorted(grant_keys)
 nkeys = len(skeys)
-default = OrderedDict([(k, None) for k in skeys])
-default['gen'] = gen
-default['path'] = fname
+
+# detect generation
+def detect_gen(fname):
+    if fname.endswith('.dat') or re.match(r'\d{4}\b', fname):
+        return 1
+    elif fname.startswith('pgb'):
+        return 2
+    elif fname.startswith('ipgb'):
+        return 3
+    else:
+        raise Exception('Unknown format')
 
 # database setup
-if write:
-    con = sqlite3.connect(args.db)
-    cur = con.cursor()
-    if args.clobber:
+def init_db(cur, clobber=False):
+    if clobber:
         cur.execute('drop table if exists grant')
         cur.execute('drop index if exists idx_patnum')
     sig = ', '.join(['%s text' % k for k in skeys])
     cur.execute('create table if not exists grant (%s)' % sig)
     cur.execute('create unique index if not exists idx_patnum on grant (patnum)')
+    init_ipc(cur, 'grant', 'patnum', clobber=clobber)
 
-# storage
-pats = []
-cmd = 'insert or replace into grant values (%s)' % ','.join(['?' for _ in skeys])
-def commit_patents():
-    cur.executemany(cmd, pats)
-    con.commit()
-    del(pats[:])
-
-# chunking express
-n = 0
-def add_patent(p):
-    global n
-    n += 1
-
-    # storage
-    if write:
-        pats.append(list(p.values()))
-        if len(pats) >= args.chunk:
-            commit_patents()
-
-    # output
-    if args.output > 0:
-        if n % args.output == 0:
-            print('pat = %d'%n)
-            for (k, v) in p.items():
-                print('%s = %s' % (k, v))
-            print()
-
-    # break
-    if args.limit > 0:
-        if n >= args.limit:
-            return False
+insert_cmd = 'insert or replace into grant values (%s)' % ','.join(['?' for _ in skeys])
 
-    return True
+# gen 1: APS text format, line by line (reference engine)
+def iter_gen1_lines(fpath, default):
+    with open_data(fpath, encoding='latin1') as f:
+        yield from parse_aps(chain(f, ['PATN', 'PATN']), default)
 
-# parse it up
-print('Parsing %s, gen %d' % (fname, gen))
-if gen == 1:
+# tagged line state machine
+def parse_aps(lines, default):
     pat = None
     sec = None
     tag = None
     ipclist = []
-    for nline in chain(open(args.path, encoding='latin1'), ['PATN']):
+    for nline in lines:
         # peek at next line
         ntag, nbuf = nline[:4].rstrip(), nline[5:-1]
         if tag is None:
@@ -135,8 +92,7 @@ if gen == 1:
                 pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
                 pat['ipc2'] = ';'.join(ipclist)
                 pat['appnum'] = src + apn
-                if not add_patent(pat):
-                    break
+                yield pat
             pat = copy(default)
             sec = 'PATN'
             ipclist = []
@@ -194,157 +150,384 @@ if gen == 1:
         # stage next tag and buf
         tag = ntag
         buf = nbuf
-elif gen == 2:
-    def handle_patent(elem):
-        pat = copy(default)
-
-        # top-level section
-        bib = elem.find('SDOBI')
-
-        # publication info
-        pubref = bib.find('B100')
-        pat['patnum'] = prune_patnum(get_text(pubref, 'B110/DNUM/PDAT'))
-        pat['pubdate'] = get_text(pubref, 'B140/DATE/PDAT')
-
-        # application info
-        appref = bib.find('B200')
-        pat['appnum'] = get_text(appref, 'B210/DNUM/PDAT')
-        pat['appdate'] = get_text(appref, 'B220/DATE/PDAT')
-
-        # reference info
-        patref = bib.find('B500')
-        ipclist = []
-        ipcsec = patref.find('B510')
-        if ipcsec is not None:
-            pat['ipcver'] = get_text(ipcsec, 'B516/PDAT')
-            ipclist = list(gen15_ipc(ipcsec))
-        pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
-        pat['ipc2'] = ';'.join(ipclist)
-        pat['title'] = get_text(patref, 'B540/STEXT/PDAT')
-        pat['claims'] = get_text(patref, 'B570/B577/PDAT')
-
-        # applicant name and address
-        ownref = bib.find('B700/B730/B731/PARTY-US')
-        if ownref is not None:
-            pat['appname'] = get_text(ownref, 'NAM/ONM/STEXT/PDAT')
-            address = ownref.find('ADR')
-            if address is not None:
-                pat['city'] = get_text(address, 'CITY/PDAT')
-                pat['state'] = get_text(address, 'STATE/PDAT')
-                pat['country'] = get_text(address, 'CTRY/PDAT')
-
-        # abstract
-        abspars = elem.findall('SDOAB/BTEXT/PARA')
-        if len(abspars) > 0:
-            pat['abstract'] = '\n'.join([raw_text(e) for e in abspars])
-
-        # roll it in
-        return add_patent(pat)
-
-    # parse mangled xml
-    pp = XMLPullParser(tag='PATDOC', events=['end'], recover=True)
-    def handle_all():
-        for _, pat in pp.read_events():
-            if not handle_patent(pat):
-                return False
-        return True
-
-    with open(args.path, errors='ignore') as f:
-        pp.feed('<root>\n')
-        for line in f:
-            if line.startswith('<?xml'):
-                if not handle_all():
-                    break
-            elif line.startswith('<!DOCTYPE') or line.startswith('<!ENTITY') or line.startswith(']>'):
-                pass
-            else:
-                pp.feed(line)
+
+# gen 1: APS text format, split into PATN records on raw bytes
+aps_sections = ['INVT', 'ASSG', 'PRIR', 'CLAS', 'UREF', 'FREF', 'OREF', 'LREP', 'PCTA', 'ABST']
+aps_pars = ['PAL', 'PAR', 'PAC', 'PA0', 'PA1']
+aps_tags = set(['PATN', 'WKU', 'SRC', 'APN', 'ISD', 'APD', 'ICL', 'EDF', 'TTL', 'NCL', 'NAM', 'CTY', 'STA', 'CNT'] + aps_sections + aps_pars)
+aps_padded = {t.ljust(4): t for t in aps_tags}
+
+# records start after a newline, which is a bare \r in files with old mac line endings
+# (\r\n files still have the \n), decided once from the head of the buffer
+def aps_sep(buf):
+    head = buf[:1<<16]
+    return b'\rPATN' if b'\n' not in head and b'\r' in head else b'\nPATN'
+
+# split a buffer into PATN records (anything before the first one is header)
+def aps_records(buf):
+    sep = aps_sep(buf)
+    if buf[:4] == b'PATN':
+        start = 0
+    else:
+        start = buf.find(sep) + 1
+        if start == 0:
+            return
+    while True:
+        end = buf.find(sep, start)
+        if end == -1:
+            yield buf[start:]
+            return
+        yield buf[start:end+1]
+        start = end + 1
+
+# same for streams (zip members), carrying the partial record over between blocks
+def aps_records_stream(f, size=1<<24):
+    buf = b''
+    sep = None
+    while True:
+        block = f.read(size)
+        if len(block) == 0:
+            break
+        buf += block
+        if sep is None:
+            sep = aps_sep(buf)
+        cut = buf.rfind(sep)
+        if cut == -1:
+            continue
+        yield from aps_records(buf[:cut+1])
+        buf = buf[cut+1:]
+    yield from aps_records(buf)
+
+# field (tag, value) pairs with continuation lines folded in, skipping tags we don't use
+def aps_fields(text):
+    # standard continuation lines are indented five spaces, so fold those in one go
+    lines = text.replace('\n     ', '').split('\n')
+    fields = []
+    for line in lines:
+        tag = aps_padded.get(line[:4])
+        if tag is None:
+            tag = line[:4].rstrip()
+            if tag == '':
+                break
+            elif tag not in aps_tags:
+                continue
+        fields.append((tag, line[5:]))
+    else:
+        return fields
+
+    # odd continuation lines left over, do it line by line
+    fields = []
+    parts = None
+    for line in text.split('\n'):
+        tag = line[:4].rstrip()
+        if tag == '':
+            if parts is not None:
+                parts.append(line[5:])
+        elif tag in aps_tags:
+            parts = [line[5:]]
+            fields.append((tag, parts))
         else:
-            pp.feed('</root>\n')
-            handle_all()
-elif gen == 3:
-    def handle_patent(elem):
-        pat = copy(default)
-
-        # top-level section
-        bib = elem.find('us-bibliographic-data-grant')
-        pubref = bib.find('publication-reference')
-        appref = bib.find('application-reference')
-
-        # published patent
-        pubinfo = pubref.find('document-id')
-        pat['patnum'] = prune_patnum(get_text(pubinfo, 'doc-number'))
-        pat['pubdate'] = get_text(pubinfo, 'date')
-
-        # filing date
-        appinfo = appref.find('document-id')
-        pat['appnum'] = get_text(appinfo, 'doc-number')
-        pat['appdate'] = get_text(appinfo, 'date')
-
-        # title
-        pat['title'] = get_text(bib, 'invention-title')
-
-        # ipc code
-        ipclist = []
-        ipcsec = bib.find('classification-ipc')
+            parts = None
+    return [(tag, ''.join(parts)) for tag, parts in fields]
+
+# one record in one pass (same output as parse_aps)
+def parse_aps_record(rec, default):
+    text = rec.decode('latin1')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if text.endswith('\n'):
+        text = text[:-1]
+    else:
+        text = text[:-1] + '\n'
+
+    pat = default.copy()
+    sec = 'PATN'
+    ipclist = []
+    abstract = []
+    src, apn = '', ''
+    for tag, buf in aps_fields(text):
+        if tag in aps_sections:
+            sec = tag
+        elif tag in aps_pars:
+            if sec == 'ABST':
+                abstract.append(buf)
+        elif sec == 'PATN':
+            if tag == 'WKU':
+                pat['patnum'] = prune_patnum(buf)
+            elif tag == 'SRC':
+                src = buf.strip()
+                src = '29' if src == 'D' else src.zfill(2) # design patents get series code 29
+            elif tag == 'APN':
+                apn = buf[:6]
+            elif tag == 'ISD':
+                pat['pubdate'] = buf
+            elif tag == 'APD':
+                pat['appdate'] = buf
+            elif tag == 'TTL':
+                pat['title'] = buf
+            elif tag == 'NCL':
+                pat['claims'] = buf
+        elif sec == 'CLAS':
+            if tag == 'ICL':
+                ipclist.append(pad_ipc(buf.strip()))
+            elif tag == 'EDF':
+                pat['ipcver'] = buf
+        elif sec == 'ASSG':
+            if tag == 'NAM':
+                pat['appname'] = buf
+            elif tag == 'CTY':
+                pat['city'] = buf
+            elif tag == 'STA':
+                pat['state'] = buf
+                pat['country'] = 'US'
+            elif tag == 'CNT':
+                pat['country'] = buf[:2]
+
+    if len(abstract) > 0:
+        pat['abstract'] = '\n'.join(abstract)
+    pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
+    pat['ipc2'] = ';'.join(ipclist)
+    pat['appnum'] = src + apn
+    return pat
+
+# memory map plain files, stream zips
+def iter_gen1(fpath, default):
+    with open_raw(fpath) as f:
+        if fpath.endswith('.zip'):
+            for rec in aps_records_stream(f):
+                yield parse_aps_record(rec, default)
+        elif os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for rec in aps_records(buf):
+                    yield parse_aps_record(rec, default)
+
+# gen 2: SGML-ish xml (pgb)
+def handle_gen2(elem, default):
+    pat = copy(default)
+
+    # top-level section
+    bib = elem.find('SDOBI')
+
+    # publication info
+    pubref = bib.find('B100')
+    pat['patnum'] = prune_patnum(get_text(pubref, 'B110/DNUM/PDAT'))
+    pat['pubdate'] = get_text(pubref, 'B140/DATE/PDAT')
+
+    # application info
+    appref = bib.find('B200')
+    pat['appnum'] = get_text(appref, 'B210/DNUM/PDAT')
+    pat['appdate'] = get_text(appref, 'B220/DATE/PDAT')
+
+    # reference info
+    patref = bib.find('B500')
+    ipclist = []
+    ipcsec = patref.find('B510')
+    if ipcsec is not None:
+        pat['ipcver'] = get_text(ipcsec, 'B516/PDAT')
+        ipclist = list(gen15_ipc(ipcsec))
+    pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
+    pat['ipc2'] = ';'.join(ipclist)
+    pat['title'] = get_text(patref, 'B540/STEXT/PDAT')
+    pat['claims'] = get_text(patref, 'B570/B577/PDAT')
+
+    # applicant name and address
+    ownref = bib.find('B700/B730/B731/PARTY-US')
+    if ownref is not None:
+        pat['appname'] = get_text(ownref, 'NAM/ONM/STEXT/PDAT')
+        address = ownref.find('ADR')
+        if address is not None:
+            pat['city'] = get_text(address, 'CITY/PDAT')
+            pat['state'] = get_text(address, 'STATE/PDAT')
+            pat['country'] = get_text(address, 'CTRY/PDAT')
+
+    # abstract
+    abspars = elem.findall('SDOAB/BTEXT/PARA')
+    if len(abspars) > 0:
+        pat['abstract'] = '\n'.join([raw_text(e) for e in abspars])
+
+    # roll it in
+    return pat
+
+def iter_gen2(fpath, default):
+    with open_data(fpath, errors='ignore') as f:
+        for elem in iter_xml(f, 'PATDOC', skip=('<!DOCTYPE', '<!ENTITY', ']>')):
+            yield handle_gen2(elem, default)
+
+# gen 3: proper xml (ipgb)
+def handle_gen3(elem, default):
+    pat = copy(default)
+
+    # top-level section
+    bib = elem.find('us-bibliographic-data-grant')
+    pubref = bib.find('publication-reference')
+    appref = bib.find('application-reference')
+
+    # published patent
+    pubinfo = pubref.find('document-id')
+    pat['patnum'] = prune_patnum(get_text(pubinfo, 'doc-number'))
+    pat['pubdate'] = get_text(pubinfo, 'date')
+
+    # filing date
+    appinfo = appref.find('document-id')
+    pat['appnum'] = get_text(appinfo, 'doc-number')
+    pat['appdate'] = get_text(appinfo, 'date')
+
+    # title
+    pat['title'] = get_text(bib, 'invention-title')
+
+    # ipc code
+    ipclist = []
+    ipcsec = bib.find('classification-ipc')
+    if ipcsec is not None:
+        pat['ipcver'] = get_text(ipcsec, 'edition')
+        ipclist = list(gen3g_ipc(ipcsec))
+    else:
+        ipcsec = bib.find('classifications-ipcr')
         if ipcsec is not None:
-            pat['ipcver'] = get_text(ipcsec, 'edition')
-            ipclist = list(gen3g_ipc(ipcsec))
-        else:
-            ipcsec = bib.find('classifications-ipcr')
-            if ipcsec is not None:
-                pat['ipcver'] = get_text(ipcsec, 'classification-ipcr/ipc-version-indicator/date')
-                ipclist = list(gen3r_ipc(ipcsec))
-        pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
-        pat['ipc2'] = ';'.join(ipclist)
-
-        # claims
-        pat['claims'] = get_text(bib, 'number-of-claims')
-
-        # applicant name and address
-        assignee = bib.find('assignees/assignee/addressbook')
-        if assignee is not None:
-            pat['appname'] = get_text(assignee, 'orgname')
-            address = assignee.find('address')
-            if address is not None:
-                pat['city'] = get_text(address, 'city')
-                pat['state'] = get_text(address, 'state')
-                pat['country'] = get_text(address, 'country')
-
-        # abstract
-        abspar = elem.find('abstract')
-        if abspar is not None:
-            pat['abstract'] = raw_text(abspar, sep=' ').strip()
-
-        # roll it in
-        return add_patent(pat)
-
-    # parse mangled xml
-    pp = XMLPullParser(tag='us-patent-grant', events=['end'], recover=True)
-    def handle_all():
-        for _, pat in pp.read_events():
-            if not handle_patent(pat):
-                return False
-        return True
-
-    with open(args.path, errors='ignore') as f:
-        pp.feed('<root>\n')
-        for line in f:
-            if line.startswith('<?xml'):
-                if not handle_all():
-                    break
-            elif line.startswith('<!DOCTYPE'):
-                pass
-            else:
-                pp.feed(line)
+            pat['ipcver'] = get_text(ipcsec, 'classification-ipcr/ipc-version-indicator/date')
+            ipclist = list(gen3r_ipc(ipcsec))
+    pat['ipc1'] = ipclist.pop(0) if len(ipclist) > 0 else ''
+    pat['ipc2'] = ';'.join(ipclist)
+
+    # claims
+    pat['claims'] = get_text(bib, 'number-of-claims')
+
+    # applicant name and address
+    assignee = bib.find('assignees/assignee/addressbook')
+    if assignee is not None:
+        pat['appname'] = get_text(assignee, 'orgname')
+        address = assignee.find('address')
+        if address is not None:
+            pat['city'] = get_text(address, 'city')
+            pat['state'] = get_text(address, 'state')
+            pat['country'] = get_text(address, 'country')
+
+    # abstract
+    abspar = elem.find('abstract')
+    if abspar is not None:
+        pat['abstract'] = raw_text(abspar, sep=' ').strip()
+
+    # roll it in
+    return pat
+
+def iter_gen3(fpath, default):
+    with open_data(fpath, errors='ignore') as f:
+        for elem in iter_xml(f, 'us-patent-grant', skip=('<!DOCTYPE',)):
+            yield handle_gen3(elem, default)
+
+# default values for a file
+def file_default(fname):
+    default = OrderedDict([(k, None) for k in skeys])
+    default['gen'] = detect_gen(fname)
+    default['path'] = fname
+    return default
+
+# iterate over patents in a single file (plain or zipped)
+# engine picks the gen 1 parser: 'records' (mmap + record split) or 'lines' (reference)
+def iter_grants(fpath, engine='records'):
+    fname = data_name(fpath)
+    default = file_default(fname)
+    gen1 = {'records': iter_gen1, 'lines': iter_gen1_lines}[engine]
+    parser = {1: gen1, 2: iter_gen2, 3: iter_gen3}[default['gen']]
+    yield from parser(fpath, default)
+
+if __name__ == '__main__':
+    import argparse
+    from itertools import islice
+    from perf import start_stage, finish_stage
+
+    # parse input arguments
+    parser = argparse.ArgumentParser(description='patent grant parser')
+    parser.add_argument('path', type=str, help='path of file to parse (or zip archive)')
+    parser.add_argument('--db', type=str, default='store/patents.db', help='database file to store to')
+    parser.add_argument('--clobber', action='store_true', help='delete database and restart')
+    parser.add_argument('--output', type=int, default=0, help='print out patents per')
+    parser.add_argument('--limit', type=int, default=0, help='only parse n patents')
+    parser.add_argument('--chunk', type=int, default=1000, help='chunk insert size')
+    parser.add_argument('--force', action='store_true', help='parse even if already loaded')
+    parser.add_argument('--parquet', type=str, default=None, help='also write parquet dataset to this directory')
+    parser.add_argument('--engine', type=str, default='records', choices=['records', 'lines'], help='gen 1 parser')
+    parser.add_argument('--profile', type=str, default=None, choices=['cprofile', 'sample'], help='dump a profile of the run')
+    parser.add_argument('--profile-dir', type=str, default='perf', help='directory for profile dumps')
+    args = parser.parse_args()
+
+    # for later (load is false when only the parquet output is missing)
+    write = args.db is not None
+    load = write
+    perf = start_stage('parse_grant', profile=args.profile)
+
+    # database setup
+    if write:
+        con = sqlite3.connect(args.db)
+        cur = con.cursor()
+        init_db(cur, clobber=args.clobber)
+
+        # skip files that are already fully loaded
+        init_manifest(cur, clobber='grant' if args.clobber else None)
+        info = file_stat(args.path)
+        if not args.force and is_complete(cur, info, args.path):
+            if args.parquet is None or has_parquet(cur, info, args.parquet):
+                print('Skipping %s, already loaded' % info[0])
+                con.commit()
+                sys.exit()
+            print('%s already loaded, writing parquet only' % info[0])
+            load = False
         else:
-            pp.feed('</root>\n')
-            handle_all()
+            mark_started(cur, info, 'grant')
+        con.commit()
 
-if write:
-    # commit to db and close
-    commit_patents()
-    cur.close()
-    con.close()
+    # storage
+    pats = []
+    ipcs = []
+    table = []
+    def commit_patents():
+        cur.executemany(insert_cmd, pats)
+        write_ipcs(cur, 'grant', 'patnum', ipcs)
+        con.commit()
+        del(pats[:])
+        del(ipcs[:])
+
+    # parse it up
+    fname = data_name(args.path)
+    print('Parsing %s, gen %d' % (fname, detect_gen(fname)))
+
+    n = 0
+    t0 = time.time()
+    grants = iter_grants(args.path, engine=args.engine)
+    if args.limit > 0:
+        grants = islice(grants, args.limit)
+    for n, p in enumerate(grants, 1):
+        # storage
+        if load:
+            pats.append(list(p.values()))
+            ipcs.append((p['patnum'], ipc_rows(p)))
+            if len(pats) >= args.chunk:
+                commit_patents()
+        if args.parquet is not None:
+            table.append(list(p.values()))
+
+        # output
+        if args.output > 0:
+            if n % args.output == 0:
+                print('pat = %d'%n)
+                for (k, v) in p.items():
+                    print('%s = %s' % (k, v))
+                print()
+
+    # columnar output for the whole file
+    if args.parquet is not None:
+        write_parquet(table, skeys, args.parquet, 'grant', os.path.basename(args.path))
 
-print('Found %d patents' % n)
+    if write:
+        # commit to db (along with manifest if we got the whole file) and close
+        if args.limit == 0:
+            if load:
+                mark_complete(cur, info, file_checksum(args.path), n, time.time()-t0)
+            if args.parquet is not None:
+                mark_parquet(cur, info, args.parquet)
+        commit_patents()
+        finish_stage(con, perf, rows_in=n, rows_out=n, profile_dir=args.profile_dir)
+        cur.close()
+        con.close()
+
+    print('Found %d patents' % n)
@@ -0,0 +1,211 @@
+# common storage tools
+
+import os
+import zlib
+import zipfile
+
+from parse_tools import zip_member, ipc_ranks
+
+##
+## ingestion manifest
+##
+
+# one row per source file, status goes started -> complete
+def init_manifest(cur, clobber=None):
+    cur.execute('create table if not exists manifest (file text primary key, ptype text, size int, checksum text, records int, ptime real, status text, mtime real, parquet text)')
+    cols = [c[1] for c in cur.execute('pragma table_info(manifest)')]
+    if 'mtime' not in cols:
+        cur.execute('alter table manifest add column mtime real')
+    if 'parquet' not in cols:
+        cur.execute('alter table manifest add column parquet text')
+    if clobber is not None:
+        cur.execute('delete from manifest where ptype = ?', (clobber,))
+
+# zips carry a crc of the data member for free, plain files get read once
+def file_checksum(fpath, chunk=1<<24):
+    if fpath.endswith('.zip'):
+        with zipfile.ZipFile(fpath) as zf:
+            return '%08x' % zip_member(zf).CRC
+    crc = 0
+    with open(fpath, 'rb') as f:
+        while True:
+            buf = f.read(chunk)
+            if len(buf) == 0:
+                break
+            crc = zlib.crc32(buf, crc)
+    return '%08x' % crc
+
+# cheap identity of a file, the checksum is only taken for files that get parsed
+def file_stat(fpath):
+    fname = os.path.basename(fpath)
+    st = os.stat(fpath)
+    return fname, st.st_size, st.st_mtime
+
+# only skip if it's the same file that finished last time (same size and mtime), rows from
+# before mtimes were recorded get checked against the checksum once and then carry the mtime
+def is_complete(cur, stat, fpath):
+    fname, size, mtime = stat
+    ret = cur.execute('select size, mtime, checksum, status from manifest where file = ?', (fname,)).fetchone()
+    if ret is None or ret[0] != size or ret[3] != 'complete':
+        return False
+    if ret[1] is None:
+        if ret[2] != file_checksum(fpath):
+            return False
+        cur.execute('update manifest set mtime = ? where file = ?', (mtime, fname))
+        return True
+    return ret[1] == mtime
+
+# anything left as started after a crash gets parsed again (rows are insert or replace)
+def mark_started(cur, stat, ptype):
+    fname, size, mtime = stat
+    cur.execute('insert or replace into manifest values (?,?,?,?,?,?,?,?,?)', (fname, ptype, size, None, None, None, 'started', mtime, None))
+
+def mark_complete(cur, stat, checksum, records, ptime):
+    fname, size, mtime = stat
+    cur.execute('update manifest set checksum = ?, records = ?, ptime = ?, status = ? where file = ?', (checksum, records, ptime, 'complete', fname))
+
+# parquet output is tracked on its own (the directory it went to), so a file that is already
+# in sqlite only needs parsing again to write parquet, and reparsing a file clears it
+def has_parquet(cur, stat, parquet):
+    fname, size, mtime = stat
+    ret = cur.execute('select parquet from manifest where file = ?', (fname,)).fetchone()
+    return ret is not None and ret[0] == os.path.abspath(parquet)
+
+def mark_parquet(cur, stat, parquet):
+    fname, size, mtime = stat
+    cur.execute('update manifest set parquet = ? where file = ?', (os.path.abspath(parquet), fname))
+
+##
+## ipc rows
+##
+
+# ranked ipc codes per patent, written alongside the patent rows
+def init_ipc(cur, ptype, key, clobber=False):
+    if clobber:
+        cur.execute(f'drop table if exists ipc_{ptype}')
+    cur.execute(f'create table if not exists ipc_{ptype} ({key} text, version text, code text, rank int)')
+    cur.execute(f'create index if not exists idx_ipc_{ptype} on ipc_{ptype} ({key})')
+
+# (version, code, rank) rows for one patent
+def ipc_rows(pat):
+    return [(pat['ipcver'], code, rank) for rank, code in ipc_ranks(pat['ipc1'], pat['ipc2'])]
+
+# items are (id, rows) pairs, a patent seen again replaces its old codes (like insert or replace)
+def write_ipcs(cur, ptype, key, items):
+    latest = {i: rows for i, rows in items if i is not None}
+    cur.executemany(f'delete from ipc_{ptype} where {key} = ?', [(i,) for i in latest])
+    cur.executemany(f'insert into ipc_{ptype} values (?,?,?,?)', [(i,) + r for i, rows in latest.items() for r in rows])
+
+##
+## bulk loading
+##
+
+# wal journal, no syncing and a big cache, only for loads we can redo
+def bulk_pragmas(cur):
+    cur.execute('pragma journal_mode = wal')
+    cur.execute('pragma synchronous = off')
+    cur.execute('pragma cache_size = -1000000')
+    cur.execute('pragma temp_store = memory')
+
+# unindexed copy of the table to append into (leftovers from a crash are redone anyway)
+# ipc rows carry the stage rowid of their patent so they can follow it through the dedupe
+def init_stage(cur, table):
+    cur.execute(f'drop table if exists {table}_stage')
+    cur.execute(f'create table {table}_stage as select * from {table} where 0')
+    cur.execute(f'drop table if exists ipc_{table}_stage')
+    cur.execute(f'create table ipc_{table}_stage (srow int, id text, version text, code text, rank int)')
+
+def stage_cmd(table, ncols):
+    qsig = ','.join(['?' for _ in range(ncols)])
+    return f'insert into {table}_stage values ({qsig})'
+
+# the stage table is append only, so rows get rowids 1, 2, ... in insert order
+def stage_ipcs(cur, table, start, items):
+    cur.executemany(f'insert into ipc_{table}_stage values (?,?,?,?,?)', [(start + k, i) + r for k, (i, rows) in enumerate(items) for r in rows])
+
+# dedupe staged rows (last one wins, like insert or replace) into the existing ones, index once
+# and swap the result in, run it inside a transaction (begin) so readers see either the old or
+# the new tables, the caller commits once everything that goes with it is done too
+def merge_stage(con, table, key, index):
+    cur = con.cursor()
+    if cur.execute(f'select 1 from {table}_stage limit 1').fetchone() is None:
+        cur.execute(f'drop table {table}_stage')
+        cur.execute(f'drop table ipc_{table}_stage')
+        return cur.execute(f'select count(*) from {table}').fetchone()[0]
+    cur.execute(f'drop table if exists {table}_new')
+    cur.execute(f'create table {table}_new as select * from {table} where 0')
+    cur.execute(f'insert into {table}_new select * from {table} where {key} is null or {key} not in (select {key} from {table}_stage where {key} is not null)')
+    cur.execute(f'insert into {table}_new select * from {table}_stage where {key} is null or rowid in (select max(rowid) from {table}_stage group by {key})')
+    cur.execute(f'drop table {table}')
+    cur.execute(f'alter table {table}_new rename to {table}')
+    cur.execute(f'create unique index {index} on {table} ({key})')
+
+    # ipc codes follow whichever patent row won
+    cur.execute(f'drop table if exists ipc_{table}_new')
+    cur.execute(f'create table ipc_{table}_new as select * from ipc_{table} where 0')
+    cur.execute(f'insert into ipc_{table}_new select * from ipc_{table} where {key} not in (select {key} from {table}_stage where {key} is not null)')
+    cur.execute(f'insert into ipc_{table}_new select id, version, code, rank from ipc_{table}_stage where srow in (select max(rowid) from {table}_stage where {key} is not null group by {key})')
+    cur.execute(f'drop table ipc_{table}')
+    cur.execute(f'alter table ipc_{table}_new rename to ipc_{table}')
+    cur.execute(f'create index idx_ipc_{table} on ipc_{table} ({key})')
+
+    cur.execute(f'drop table {table}_stage')
+    cur.execute(f'drop table ipc_{table}_stage')
+    return cur.execute(f'select count(*) from {table}').fetchone()[0]
+
+##
+## parquet output (needs pyarrow)
+##
+
+# hive layout root/ptype/year=YYYY/gen=N, files named after the source file so a rerun replaces them
+def write_parquet(rows, keys, root, ptype, fname):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if len(rows) == 0:
+        return
+
+    cols = {k: [None if v is None else str(v) for v in vals] for k, vals in zip(keys, zip(*rows))}
+    cols['year'] = [p[:4] if p else None for p in cols['pubdate']]
+    table = pa.table({k: pa.array(v, type=pa.string()) for k, v in cols.items()})
+
+    stem = os.path.splitext(fname)[0]
+    pq.write_to_dataset(
+        table, os.path.join(root, ptype), partition_cols=['year', 'gen'],
+        basename_template=f'{stem}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore'
+    )
+
+# year and gen come back as strings, like they were written and like the tables have them
+def parquet_partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([('year', pa.string()), ('gen', pa.string())]), flavor='hive')
+
+# the dataset of one ptype, None if nothing was written for it (like apply when only grants were parsed)
+def parquet_dataset(root, ptype):
+    import pyarrow.dataset as ds
+    path = os.path.join(root, ptype)
+    if not os.path.isdir(path):
+        return None
+    data = ds.dataset(path, format='parquet', partitioning=parquet_partitioning())
+    return data if len(data.files) > 0 else None
+
+# filters are pyarrow dnf tuples like [('year', '>=', '2000')], pushed down to partitions and row groups
+def read_parquet(root, ptype, columns=None, filters=None):
+    import pandas as pd
+    import pyarrow.parquet as pq
+    data = parquet_dataset(root, ptype)
+    if data is None:
+        return pd.DataFrame(columns=columns)
+    expr = pq.filters_to_expression(filters) if filters is not None else None
+    return data.to_table(columns=columns, filter=expr).to_pandas()
+
+# same but streamed in record batches
+def iter_parquet(root, ptype, columns=None, filters=None, chunksize=100_000):
+    import pyarrow.parquet as pq
+    data = parquet_dataset(root, ptype)
+    if data is None:
+        return
+    expr = pq.filters_to_expression(filters) if filters is not None else None
+    for batch in data.to_batches(columns=columns, filter=expr, batch_size=chunksize):
+        yield batch.to_pandas()
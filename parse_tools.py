@@ -1,6 +1,11 @@
 # common parsing tools
 
 import re
+import os
+import io
+import zipfile
+from contextlib import contextmanager
+from lxml.etree import XMLPullParser
 
 ##
 ## text tools
@@ -13,6 +18,80 @@ def get_text(parent, tag, default=''):
 def raw_text(par, sep=''):
     return sep.join(par.itertext()).strip()
 
+##
+## file tools
+##
+
+# the actual data file in a uspto zip (skipping the txt/html extras)
+def zip_member(zf):
+    infos = [i for i in zf.infolist() if not i.is_dir()]
+    datas = [i for i in infos if i.filename.lower().endswith(('.dat', '.xml'))]
+    if len(datas) == 0:
+        datas = infos
+    if len(datas) == 0:
+        raise Exception('Empty archive')
+    return max(datas, key=lambda i: i.file_size)
+
+# name of the underlying data file (used for generation detection and the path field)
+def data_name(fpath):
+    if fpath.endswith('.zip'):
+        with zipfile.ZipFile(fpath) as zf:
+            return os.path.basename(zip_member(zf).filename)
+    else:
+        return os.path.basename(fpath)
+
+# open a data file as bytes, streaming straight out of the zip if need be
+@contextmanager
+def open_raw(fpath):
+    if fpath.endswith('.zip'):
+        with zipfile.ZipFile(fpath) as zf, zf.open(zip_member(zf)) as raw:
+            yield raw
+    else:
+        with open(fpath, 'rb') as f:
+            yield f
+
+# open a data file as text, streaming straight out of the zip if need be
+@contextmanager
+def open_data(fpath, encoding=None, errors=None):
+    if fpath.endswith('.zip'):
+        with open_raw(fpath) as raw:
+            yield io.TextIOWrapper(raw, encoding=encoding, errors=errors)
+    else:
+        with open(fpath, encoding=encoding, errors=errors) as f:
+            yield f
+
+##
+## xml tools
+##
+
+# drop a finished document (and anything before it) so the tree under root stays small
+def free_elem(elem):
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+        parent.remove(elem)
+
+# the weekly files are many xml docs glued together, so wrap them in a root and strip the headers
+# each document is freed once the consumer asks for the next one, so memory is bounded by the largest doc
+def iter_xml(lines, tag, skip=('<!DOCTYPE',)):
+    pp = XMLPullParser(tag=tag, events=['end'], recover=True)
+    def read_all():
+        for _, elem in pp.read_events():
+            yield elem
+            free_elem(elem)
+    pp.feed('<root>\n')
+    for line in lines:
+        if line.startswith('<?xml'):
+            yield from read_all()
+        elif line.startswith(skip):
+            pass
+        else:
+            pp.feed(line)
+    pp.feed('</root>\n')
+    yield from read_all()
+
 ##
 ## patnum pruners
 ##
@@ -67,3 +146,12 @@ def gen3r_ipc(ipcsec):
     for ipc in ipcsec.findall('classification-ipcr'):
         yield get_text(ipc, 'section') + get_text(ipc, 'class') + get_text(ipc, 'subclass') \
             + get_text(ipc, 'main-group').zfill(3) + '/' + get_text(ipc, 'subgroup')
+
+# ranked (rank, code) pairs from the ipc1/ipc2 fields, as stored in the ipc tables
+def ipc_ranks(ipc1, ipc2):
+    codes = []
+    if ipc1 is not None and len(ipc1) > 0:
+        codes.append(ipc1)
+    if ipc2 is not None and len(ipc2) > 0:
+        codes += ipc2.split(';')
+    return list(enumerate(codes, 1))
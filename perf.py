@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# stage profiling: wall and cpu time, peak rss and rows in/out per stage into the perf_log
+# table, with optional cProfile or sampled stack dumps, and the README table rendered from it
+
+import os
+import sys
+import time
+import signal
+import sqlite3
+import cProfile
+import resource
+import argparse
+import subprocess
+from collections import Counter
+
+def init_perf(con):
+    con.execute('create table if not exists perf_log (stage text, started text, wall real, cpu real, peak_rss real, rows_in int, rows_out int, git_commit text)')
+
+# commit the numbers belong to (marked if the tree has uncommitted changes)
+def git_commit():
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True, text=True).stdout.strip()
+        return rev + ('+' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# linux lets the peak rss (VmHWM) be reset through clear_refs, so each stage gets its own peak,
+# elsewhere it is the peak of the whole process so far
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == 'darwin' else peak/1024
+
+# cpu of this process (all threads) plus any child processes that have finished, like a pool
+def cpu_time():
+    child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + child.ru_utime + child.ru_stime
+
+# stack samples every interval seconds of cpu time, written out in collapsed form (one
+# "outer;...;inner count" line per stack) for flame graph tools
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+profilers = {'cprofile': (cProfile.Profile, 'prof'), 'sample': (Sampler, 'folded')}
+
+# call at the start of a stage, profile is None, cprofile or sample
+def start_stage(stage, profile=None):
+    reset_peak()
+    prof = None
+    if profile is not None:
+        prof = profilers[profile][0]()
+        prof.enable()
+    return {'stage': stage, 'profile': profile, 'prof': prof, 'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'wall': time.perf_counter(), 'cpu': cpu_time()}
+
+# and at the end, profiles go to profile_dir/<stage>.prof (cprofile) or .folded (sample)
+def finish_stage(con, state, rows_in=None, rows_out=None, profile_dir='perf'):
+    wall = time.perf_counter() - state['wall']
+    cpu = cpu_time() - state['cpu']
+    peak = peak_rss()
+
+    if state['prof'] is not None:
+        state['prof'].disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f'{state["stage"]}.{profilers[state["profile"]][1]}')
+        state['prof'].dump_stats(path)
+        print(f'profile written to {path}')
+
+    init_perf(con)
+    con.execute('insert into perf_log values (?,?,?,?,?,?,?,?)', (state['stage'], state['started'], wall, cpu, peak, rows_in, rows_out, git_commit()))
+    con.commit()
+    print(f'{state["stage"]}: {wall:.1f}s wall, {cpu:.1f}s cpu, peak rss {peak:.0f} MB')
+
+# latest run of each stage, in the order stages first ran
+def latest(con):
+    return con.execute('''
+        select stage,wall,cpu,peak_rss,rows_in,rows_out,git_commit,started from perf_log
+        where rowid in (select max(rowid) from perf_log group by stage)
+        order by (select min(rowid) from perf_log p where p.stage=perf_log.stage)
+    ''').fetchall()
+
+def fmt_rows(n):
+    return '' if n is None else f'{n:,}'
+
+def fmt_time(sec):
+    return f'{sec:.0f}s' if sec >= 10 else f'{sec:.1f}s'
+
+def fmt_mem(mb):
+    return f'{mb/1024:.1f} GB' if mb >= 1024 else f'{mb:.0f} MB'
+
+def render_table(rows):
+    lines = [
+        '| routine | time | cpu | peak memory | rows in | rows out | commit |',
+        '|---------|------|-----|-------------|---------|----------|--------|',
+    ]
+    for stage, wall, cpu, peak, rows_in, rows_out, commit, _ in rows:
+        name = f'`cluster.{stage}`' if stage in ('unique_names', 'filter_pairs', 'find_groups', 'merge_firms') else f'`{stage}`'
+        lines.append(f'| {name} | {fmt_time(wall)} | {fmt_time(cpu)} | {fmt_mem(peak)} | {fmt_rows(rows_in)} | {fmt_rows(rows_out)} | {commit or ""} |')
+    return '\n'.join(lines)
+
+# the table goes between the perf markers in the readme
+begin, end = '<!-- perf table -->', '<!-- /perf table -->'
+
+def update_readme(path, table):
+    with open(path) as f:
+        text = f.read()
+    if begin not in text or end not in text:
+        raise ValueError(f'{path} has no {begin} ... {end} block')
+    head, rest = text.split(begin, 1)
+    _, tail = rest.split(end, 1)
+    with open(path, 'w') as f:
+        f.write(f'{head}{begin}\n{table}\n{end}{tail}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='stage measurements from perf_log')
+    parser.add_argument('--db', type=str, default='store/patents.db', help='database with the perf_log table')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    subparsers.add_parser('table', help='print the latest run of each stage as a markdown table')
+
+    readme = subparsers.add_parser('readme', help='write the table into the readme')
+    readme.add_argument('--path', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README.md'), help='readme to update')
+
+    history = subparsers.add_parser('history', help='every run of one stage')
+    history.add_argument('stage', type=str, help='stage name')
+
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as con:
+        init_perf(con)
+        if args.cmd == 'table':
+            print(render_table(latest(con)))
+        elif args.cmd == 'readme':
+            update_readme(args.path, render_table(latest(con)))
+            print(f'updated {args.path}')
+        elif args.cmd == 'history':
+            print(f'{"started":>19} {"commit":>9} {"wall":>8} {"cpu":>8} {"rss MB":>7} {"rows in":>11} {"rows out":>11}')
+            for started, commit, wall, cpu, peak, rows_in, rows_out in con.execute('select started,git_commit,wall,cpu,peak_rss,rows_in,rows_out from perf_log where stage=? order by rowid', (args.stage,)):
+                print(f'{started:>19} {commit or "":>9} {wall:>8.1f} {cpu:>8.1f} {peak:>7.0f} {fmt_rows(rows_in):>11} {fmt_rows(rows_out):>11}')
@@ -1,34 +1,60 @@
-DEF dim = 64
+# cython: boundscheck=False, wraparound=False
+# simhash kernels, no module state so they can run from many threads at once
 
-cdef unsigned long masks[dim]
-for i in range(dim):
-    masks[i] = 1 << i
+import os
+import numpy as np
+from libc.stdint cimport uint64_t, int64_t
+from cython.parallel cimport prange
 
-cdef float v[dim]
+cdef enum:
+    dim = 64
 
-def simcore(hashish, weights):
-    cdef unsigned long ans
-    cdef int n = len(hashish)
-    cdef unsigned long h
-    cdef float w
-    cdef float q
+# sign features f0:f1, accumulating in double like the pure python version
+cdef uint64_t sign_range(const uint64_t[:] hashes, const double[:] weights, Py_ssize_t f0, Py_ssize_t f1) noexcept nogil:
+    cdef double v[dim]
+    cdef uint64_t h, ans = 0
+    cdef double w
+    cdef Py_ssize_t i
+    cdef int j
 
     for j in range(dim):
         v[j] = 0.0
 
-    for i in range(n):
-        h = hashish[i]
+    # branch free (w times exactly +1 or -1) so the bit loop vectorizes
+    for i in range(f0, f1):
+        h = hashes[i]
         w = weights[i]
         for j in range(dim):
-            if h & masks[j]:
-              q = w
-            else:
-              q = -w
-            v[j] += q
+            v[j] += w*<double>(<int>((h >> j) & 1)*2 - 1)
 
-    ans = 0
     for j in range(dim):
         if v[j] >= 0:
-            ans |= masks[j]
+            ans |= (<uint64_t>1) << j
 
     return ans
+
+# one name: hashes and weights are sequences of the same length
+def simcore(hashish, weights):
+    cdef const uint64_t[:] h = np.asarray(hashish, dtype=np.uint64)
+    cdef const double[:] w = np.asarray(weights, dtype=np.float64)
+    cdef uint64_t ans
+    with nogil:
+        ans = sign_range(h, w, 0, h.shape[0])
+    return ans
+
+# many names in csr layout: features of row i are offsets[i]:offsets[i+1], spread over nthreads (default all cores)
+def simcore_batch(const uint64_t[:] hashes, const int64_t[:] offsets, const double[:] weights, int nthreads=0):
+    cdef Py_ssize_t n = offsets.shape[0] - 1
+    cdef Py_ssize_t i
+
+    signs = np.zeros(max(n, 0), dtype=np.uint64)
+    cdef uint64_t[:] out = signs
+
+    if nthreads <= 0:
+        nthreads = os.cpu_count() or 1
+
+    with nogil:
+        for i in prange(n, num_threads=nthreads, schedule='guided'):
+            out[i] = sign_range(hashes, weights, offsets[i], offsets[i+1])
+
+    return signs
@@ -3,6 +3,7 @@
 #
 
 from collections import defaultdict
+from itertools import combinations
 import numpy as np
 import xxhash
 
@@ -10,8 +11,9 @@ import pyximport
 pyximport.install()
 import simcore as csimcore
 
+# utf-8 like older xxhash did implicitly (newer versions only take bytes)
 def hash0(x):
-    return np.uint64(xxhash.xxh64_intdigest(x))
+    return np.uint64(xxhash.xxh64_intdigest(x.encode()))
 
 # k-shingles: pairs of adjacent k-length substrings (in order)
 def shingle(s, k=2):
@@ -52,6 +54,77 @@ class CSimhash():
         ret = np.uint64(self.simcore(hashish, weights))
         return ret
 
+# bit counts of a uint64 array (bitwise_count needs numpy 2)
+if hasattr(np, 'bitwise_count'):
+    def popcount(x):
+        return np.bitwise_count(x)
+else:
+    popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    def popcount(x):
+        x = np.ascontiguousarray(x, dtype=np.uint64)
+        return popcount_table[x.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+# hamming distance between signature arrays
+def hamming(a, b):
+    return popcount(np.bitwise_xor(a, b))
+
+##
+## batch simhash over a flat (csr) layout: features of row i are features[offsets[i]:offsets[i+1]]
+##
+
+# name features as in filter_pairs: k-shingles then words, each run weighted linearly from 1 down to 0
+def features_csr(names, k=2):
+    features = []
+    runs = []
+    for name in names:
+        shings = list(shingle(name, k))
+        words = name.split()
+        features += shings
+        features += words
+        runs.append(len(shings))
+        runs.append(len(words))
+    runs = np.array(runs, dtype=np.int64)
+
+    # same numbers np.linspace(1.0, 0.0, n) gives for each run
+    pos = np.arange(runs.sum()) - np.repeat(np.cumsum(runs) - runs, runs)
+    size = np.repeat(runs, runs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = pos*(-1.0/(size-1)) + 1.0
+    weights[size == 1] = 1.0
+    weights[(pos == size - 1) & (size > 1)] = 0.0
+
+    offsets = np.zeros(len(runs)//2+1, dtype=np.int64)
+    np.cumsum(runs.reshape(-1, 2).sum(axis=1), out=offsets[1:])
+    return features, offsets, weights
+
+# xxhash each distinct feature once
+def hash_features(features):
+    index = {}
+    codes = np.fromiter((index.setdefault(f, len(index)) for f in features), dtype=np.int64, count=len(features))
+    hashes = np.fromiter((xxhash.xxh64_intdigest(f.encode()) for f in index), dtype=np.uint64, count=len(index))
+    return hashes[codes]
+
+# signatures from feature hashes, compiled and spread over nthreads (default all cores)
+def simhash_hashed(hashes, offsets, weights=None, nthreads=0):
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    weights = np.ones(len(hashes)) if weights is None else np.ascontiguousarray(weights, dtype=np.float64)
+    return csimcore.simcore_batch(hashes, offsets, weights, nthreads)
+
+# one uint64 signature per row
+def simhash_batch(features, offsets, weights=None, nthreads=0):
+    return simhash_hashed(hash_features(features), offsets, weights, nthreads=nthreads)
+
+# signatures of names (shingles and words), chunk names at a time since the feature strings
+# of all names at once take far more memory than anything else in filter_pairs
+def simhash_names(names, nshingle=2, chunk=2_000, nthreads=0):
+    names = list(names)
+    signs = np.zeros(len(names), dtype=np.uint64)
+    for i in range(0, len(names), chunk):
+        features, offsets, weights = features_csr(names[i:i+chunk], nshingle)
+        signs[i:i+chunk] = simhash_batch(features, offsets, weights, nthreads=nthreads)
+    return signs
+
 class Cluster:
     # dim is the simhash width, k is the tolerance
     def __init__(self, dim=64, k=4, thresh=1):
@@ -69,8 +142,12 @@ class Cluster:
 
     # add item to the cluster
     def add(self, features, label, weights=None):
-        # get subkeys
         sign = self.hasher(features, weights)
+        self.add_sign(sign, label)
+
+    # add item with precomputed signature (see simhash_batch)
+    def add_sign(self, sign, label):
+        # get subkeys
         keyvec = self.get_keys(sign)
 
         # unite labels with the same keys in the same band
@@ -87,3 +164,259 @@ class Cluster:
     # bin simhash into chunks
     def get_keys(self, simhash):
         return [simhash >> offset & mask for (offset, mask) in zip(self.offsets, self.bin_masks)]
+
+# same candidates as Cluster, but from flat arrays: band keys are grouped by sorting and a pair
+# is kept if more than thresh of the k bands agree. such a pair has to share one of the first
+# k - thresh bands, so only those are grouped and the rest are checked directly
+#
+# buckets bigger than cap overflow: with 'split' they are regrouped on each further band their
+# members could share (a kept pair shares more than thresh bands, so nothing is lost), with
+# 'skip' they are dropped. each pair is only taken along the first bands it shares, so nothing
+# needs deduping either way
+#
+# maxdist additionally drops candidates whose full signatures are more than that many bits apart
+class BandIndex:
+    def __init__(self, dim=64, k=4, thresh=1, cap=None, overflow='split', maxdist=None):
+        self.dim = dim
+        self.k = k
+        self.thresh = thresh
+        self.cap = cap
+        self.overflow = overflow
+        self.maxdist = maxdist
+
+        width = dim//k
+        self.offsets = np.array([width*i for i in range(k)], dtype=np.uint64)
+        self.bin_masks = np.array([2**(dim-width*i if i == k-1 else width)-1 for i in range(k)], dtype=np.uint64)
+        self.band_bits = self.bin_masks << self.offsets
+
+        self.signs = np.zeros(0, dtype=np.uint64)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.stats = []
+        self.nbanded = 0
+        self.ndropped = 0
+
+    # items are ordered, pairs always point from the later one to the earlier one
+    def add(self, signs, labels):
+        self.signs = np.concatenate([self.signs, np.asarray(signs, dtype=np.uint64)])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=np.int64)])
+
+    # bands a pair taken along path must not share (it would have been taken along an earlier path)
+    def forbidden(self, path):
+        return sorted({x for i, c in enumerate(path) for x in range(c) if x not in path[:i]})
+
+    # group rows on the bands in path, yielding candidate (later, earlier) positions encoded as
+    # later*n + earlier in pieces of about chunk pairs, and recursing into overflowing groups
+    # only pairs whose later position is at least since are made (all of them by default)
+    # the per member arrays are the bulk of the memory, so they are built in place where possible
+    def path_pairs(self, rows, path, chunk, since=0):
+        n = len(self.signs)
+        gkey = self.signs[rows] & np.bitwise_or.reduce(self.band_bits[list(path)])
+        order = np.argsort(gkey, kind='stable')
+        rows, gkey = rows[order], gkey[order]
+        del order
+
+        brk = np.flatnonzero(gkey[1:] != gkey[:-1]) + 1
+        starts = np.concatenate([[0], brk])
+        sizes = np.diff(np.concatenate([starts, [len(rows)]]))
+        heads = gkey[starts]
+        del gkey, brk
+
+        # members stay in position order within a group, so the ones at or past since come last
+        nnew = np.add.reduceat(rows >= since, starts, dtype=np.int64)
+        nold = sizes - nnew
+
+        # past thresh + 1 bands every member pair is kept anyway, so don't split further
+        hot = np.zeros(len(sizes), dtype=bool)
+        if self.cap is not None and (len(path) <= self.thresh if self.overflow == 'split' else len(path) == 1):
+            hot = sizes > self.cap
+
+        multi = (sizes > 1) & (nnew > 0)
+        comps = np.where(hot, 0, sizes*(sizes-1)//2 - nold*(nold-1)//2)
+        status = np.where(hot, self.overflow, 'done')
+        self.stats.append((','.join(map(str, path)), heads[multi], sizes[multi], comps[multi], status[multi]))
+
+        # sorted position p pairs with everything after it up to the end of its group, but
+        # not before the group's first new member
+        lower = np.repeat(starts + nold, sizes)
+        np.maximum(lower, np.arange(1, len(rows) + 1), out=lower)
+        count = np.repeat(np.where(hot, 0, starts + sizes), sizes)
+        count -= lower
+        np.maximum(count, 0, out=count)
+        total = np.cumsum(count)
+        p0, done = 0, 0
+        while done < total[-1]:
+            p1 = max(np.searchsorted(total, done + chunk, side='right'), p0 + 1)
+            cnt = count[p0:p1]
+            first = np.repeat(np.arange(p0, p1), cnt)
+            second = lower[first] + np.arange(len(first)) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+            yield path, rows[second]*n + rows[first]
+            p0, done = p1, total[p1-1]
+
+        # hot groups differ on the path bands, so they can be regrouped together
+        hot &= nnew > 0
+        if self.overflow == 'split' and hot.any():
+            sub = rows[np.repeat(hot, sizes)]
+            skip = set(path) | set(self.forbidden(path))
+            for c in range(self.k):
+                if c not in skip:
+                    yield from self.path_pairs(sub, path + (c,), chunk, since)
+
+    # kept (later, earlier) positions as codes later*n + earlier, yielded as found in batches of
+    # about batch pairs (no particular order), candidates are checked chunk at a time
+    # with since, only pairs involving an item at that position or later (ones added since)
+    # bands are compared on the xor of each candidate pair, so nothing per band is kept around
+    def iter_codes(self, batch=100_000, chunk=1<<16, since=0):
+        n = len(self.signs)
+        self.stats = []
+        self.nbanded = 0
+        self.ndropped = 0
+        if n == 0:
+            return
+
+        found, nfound = [], 0
+        for b in range(max(self.k - self.thresh, 0)):
+            for path, codes in self.path_pairs(np.arange(n), (b,), chunk, since):
+                diff = self.signs[codes // n] ^ self.signs[codes % n]
+                same = np.empty((len(codes), self.k), dtype=bool)
+                for c, bits in enumerate(self.band_bits):
+                    np.equal(diff & bits, 0, out=same[:, c])
+                keep = same.sum(axis=1) > self.thresh
+                forbid = self.forbidden(path)
+                if len(forbid) > 0:
+                    keep &= ~same[:, forbid].any(axis=1)
+                codes = codes[keep]
+                self.nbanded += len(codes)
+                if self.maxdist is not None:
+                    close = hamming(self.signs[codes // n], self.signs[codes % n]) <= self.maxdist
+                    self.ndropped += len(codes) - close.sum()
+                    codes = codes[close]
+                found.append(codes)
+                nfound += len(codes)
+                if nfound >= batch:
+                    yield np.concatenate(found)
+                    found, nfound = [], 0
+
+        if nfound > 0:
+            yield np.concatenate(found)
+
+    # label arrays (id1, id2) with id1 added after id2 and their hamming distances
+    def decode(self, codes):
+        n = len(self.signs)
+        later, earlier = codes // n, codes % n
+        return self.labels[later], self.labels[earlier], hamming(self.signs[later], self.signs[earlier])
+
+    # (id1, id2, dist) streamed in batches
+    def iter_pairs(self, batch=100_000, chunk=1<<16, since=0):
+        for codes in self.iter_codes(batch=batch, chunk=chunk, since=since):
+            yield self.decode(codes)
+
+    # all pairs at once, ordered by id1 then id2 position
+    def pairs(self, chunk=1<<16):
+        found = list(self.iter_codes(chunk=chunk))
+        codes = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+        del found
+        codes.sort()
+        return self.decode(codes)
+
+    # one entry per bucket with more than one member from the last pair run: band path, masked
+    # signature (as signed, which sqlite can store), size, comparisons made and what happened
+    # to it (done, split or skip)
+    def bucket_stats(self):
+        if len(self.stats) == 0:
+            return {'bands': [], 'key': [], 'size': [], 'comparisons': [], 'status': []}
+        return {
+            'bands': np.concatenate([np.repeat(p, len(k)) for p, k, _, _, _ in self.stats]),
+            'key': np.concatenate([k for _, k, _, _, _ in self.stats]).view(np.int64),
+            'size': np.concatenate([s for _, _, s, _, _ in self.stats]),
+            'comparisons': np.concatenate([c for _, _, _, c, _ in self.stats]),
+            'status': np.concatenate([t for _, _, _, _, t in self.stats]),
+        }
+
+# all signatures within hamming distance radius (manku et al): the bits are cut into blocks and
+# there is one table per choice of blocks - radius blocks, holding the signatures masked to those
+# blocks in sorted order. two signatures within radius differ in at most radius blocks, so they
+# match exactly in at least one table, and lookups are binary searches plus a distance check
+class PermIndex:
+    def __init__(self, radius=3, blocks=None, dim=64):
+        self.dim = dim
+        self.radius = radius
+        self.blocks = radius + 3 if blocks is None else blocks
+
+        edges = [dim*i//self.blocks for i in range(self.blocks+1)]
+        bits = [(2**(e1-e0)-1) << e0 for e0, e1 in zip(edges[:-1], edges[1:])]
+        self.masks = np.array([sum(bits[b] for b in comb) for comb in combinations(range(self.blocks), self.blocks-radius)], dtype=np.uint64)
+
+        self.signs = np.zeros(0, dtype=np.uint64)
+        self.labels = np.zeros(0, dtype=np.int64)
+        self.build()
+
+    # sorted masked copies, one per table
+    def build(self):
+        self.orders = [np.argsort(self.signs & m, kind='stable') for m in self.masks]
+        self.tables = [(self.signs & m)[o] for m, o in zip(self.masks, self.orders)]
+
+    def add(self, signs, labels):
+        self.signs = np.concatenate([self.signs, np.asarray(signs, dtype=np.uint64)])
+        self.labels = np.concatenate([self.labels, np.asarray(labels, dtype=np.int64)])
+        self.build()
+
+    # (query position, index position, dist) for every stored signature within radius of each query,
+    # a match is only taken from the first table it agrees in so there are no repeats
+    def query_positions(self, signs):
+        signs = np.asarray(signs, dtype=np.uint64)
+        found = []
+        for t, (m, order, table) in enumerate(zip(self.masks, self.orders, self.tables)):
+            key = signs & m
+            lo = np.searchsorted(table, key, side='left')
+            hi = np.searchsorted(table, key, side='right')
+            count = hi - lo
+            qpos = np.repeat(np.arange(len(signs)), count)
+            ipos = order[np.repeat(lo, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)]
+
+            dist = hamming(signs[qpos], self.signs[ipos])
+            keep = dist <= self.radius
+            for m0 in self.masks[:t]:
+                keep &= (signs[qpos] & m0) != (self.signs[ipos] & m0)
+            found.append((qpos[keep], ipos[keep], dist[keep]))
+
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return tuple(np.concatenate(x) for x in zip(*found))
+
+    # (query position, label, dist) for many signatures, in chunks of chunk queries
+    def query_batch(self, signs, chunk=1<<14):
+        signs = np.asarray(signs, dtype=np.uint64)
+        found = []
+        for q0 in range(0, len(signs), chunk):
+            qpos, ipos, dist = self.query_positions(signs[q0:q0+chunk])
+            found.append((qpos + q0, self.labels[ipos], dist))
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return tuple(np.concatenate(x) for x in zip(*found))
+
+    # (labels, dists) within radius of one signature
+    def query(self, sign):
+        _, labels, dist = self.query_batch([sign])
+        return labels, dist
+
+    # (id1, id2, dist) for stored pairs within radius, id1 added after id2, streamed in batches
+    # with since, only pairs where id1 is at that position or later (added since)
+    def iter_pairs(self, batch=100_000, chunk=1<<14, since=0):
+        found, nfound = [], 0
+        for q0 in range(since, len(self.signs), chunk):
+            qpos, ipos, dist = self.query_positions(self.signs[q0:q0+chunk])
+            qpos += q0
+            keep = qpos > ipos
+            found.append((self.labels[qpos[keep]], self.labels[ipos[keep]], dist[keep]))
+            nfound += keep.sum()
+            if nfound >= batch:
+                yield tuple(np.concatenate(x) for x in zip(*found))
+                found, nfound = [], 0
+        if nfound > 0:
+            yield tuple(np.concatenate(x) for x in zip(*found))
+
+    def pairs(self):
+        found = list(self.iter_pairs())
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        return tuple(np.concatenate(x) for x in zip(*found))
@@ -1,4 +1,9 @@
 import re
+import hashlib
+
+# changes whenever this file does, so stored standardized names can tell they're stale
+with open(__file__, 'rb') as f:
+    version = hashlib.sha1(f.read()).hexdigest()[:12]
 
 #
 # weak name standardization
@@ -13,12 +18,15 @@ paren_re = re.compile(paren)
 punct_re = re.compile(punct)
 space_re = re.compile(space)
 
+# paren then punct in one pass (both go to a space, paren is tried first at each position)
+parpun_re = re.compile(f'{paren}|{punct}')
+
 # standardize firm name
 def standardize_weak(name):
     name = name.lower()
-    name = paren_re.sub(' ', name)
-    name = punct_re.sub(' ', name)
-    name = space_re.sub(' ', name)
+    name = parpun_re.sub(' ', name)
+    if '  ' in name:
+        name = space_re.sub(' ', name)
     return name.strip()
 
 #
@@ -65,20 +73,47 @@ jp_corps = ['kabushiki', 'kaisha', 'seisakusho']
 variants = ['trust', 'group', 'grp', 'hldgs', 'holdings', 'comm', 'inds', 'hldg', 'tech', 'international', 'comp']
 dropout = states + compustat + generics + en_corps + eu_corps + jp_corps + variants
 gener0_re = re.compile('|'.join([rf'\b{el}\b' for el in dropout]))
+dropout_set = frozenset(dropout)
+
+# gates: every acronym match starts with a one letter word followed by a space, dash or
+# ampersand (or a two letter word and an ampersand), and punct0 only matches punctuation,
+# so names failing these skip whole groups of passes with the same result
+post0_gate = re.compile(r'[;,]|\ba corp')
+acronym_gate = re.compile(r'\b\w(?:[ &-]|\w&)')
 
 # standardize a firm name
 def standardize_strong(name):
     name = name.lower()
-    name = post0_re.sub('', name)
-    name = acronym1_re.sub(r'\1\2\3', name)
-    name = acronym2_re.sub(r'\1\2', name)
-    name = acronym3_re.sub(r'\1\2\3', name)
-    name = acronym4_re.sub(r'\1\2', name)
-    name = acronym5_re.sub(r'\1\2', name)
-    name = acronym6_re.sub(r'\1\2', name)
-    name = acronym7_re.sub(r'\1\2', name)
-    name = punct0_re.sub('', name)
-    name = punct1_re.sub(' ', name)
-    name = gener0_re.sub('', name)
-    name = white0_re.sub(' ', name)
+    if post0_gate.search(name):
+        name = post0_re.sub('', name)
+    if acronym_gate.search(name):
+        name = acronym1_re.sub(r'\1\2\3', name)
+        name = acronym2_re.sub(r'\1\2', name)
+        name = acronym3_re.sub(r'\1\2\3', name)
+        name = acronym4_re.sub(r'\1\2', name)
+        name = acronym5_re.sub(r'\1\2', name)
+        name = acronym6_re.sub(r'\1\2', name)
+        name = acronym7_re.sub(r'\1\2', name)
+    if punct1_re.search(name):
+        name = punct0_re.sub('', name)
+        name = punct1_re.sub(' ', name)
+    # only words and whitespace are left, so the alternation can only hit a whole token
+    if not dropout_set.isdisjoint(name.split()):
+        name = gener0_re.sub('', name)
+    if '  ' in name:
+        name = white0_re.sub(' ', name)
     return name.strip()
+
+#
+# batches
+#
+
+# standardize many names, each distinct one only once, cache maps raw names to standardized
+# ones and is filled in as it goes so it can be kept across calls
+def standardize_batch(names, func=standardize_strong, cache=None):
+    if cache is None:
+        cache = {}
+    for name in names:
+        if name not in cache:
+            cache[name] = func(name)
+    return [cache[name] for name in names]
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+# synthetic uspto bulk files for benchmarking and checks
+
+import os
+import random
+
+# vocabulary
+words = [
+    'apparatus', 'method', 'system', 'device', 'signal', 'circuit', 'layer', 'substrate',
+    'compound', 'composition', 'vehicle', 'engine', 'valve', 'member', 'housing', 'sensor',
+    'controller', 'network', 'data', 'memory', 'optical', 'polymer', 'surface', 'fluid',
+    'electrode', 'coupled', 'second', 'first', 'plurality', 'wherein', 'providing', 'least',
+]
+firms = [
+    'International Business Machines Corporation', 'General Electric Company', 'Canon Kabushiki Kaisha',
+    'Siemens Aktiengesellschaft', 'Samsung Electronics Co., Ltd.', 'Intel Corporation',
+    'Hewlett-Packard Development Company, L.P.', 'Xerox Corporation', 'Eastman Kodak Company',
+    'Motorola, Inc.', 'Sony Corporation', 'E. I. du Pont de Nemours and Company',
+]
+cities = [('Armonk', 'NY', 'US'), ('Schenectady', 'NY', 'US'), ('Tokyo', '', 'JP'), ('Munich', '', 'DE'), ('Suwon', '', 'KR')]
+ipcs = ['G06F', 'H01L', 'A61K', 'B01D', 'C07D', 'H04N', 'G01N', 'F16K']
+
+def sentence(rng, n):
+    return ' '.join(rng.choice(words) for _ in range(n))
+
+def record(rng, i, base=3930000):
+    city, state, country = rng.choice(cities)
+    return {
+        'num': base + i,
+        'appnum': 100000 + i,
+        'pubdate': f'{rng.randint(1976, 2020)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}',
+        'appdate': f'{rng.randint(1970, 2019)}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}',
+        'title': sentence(rng, rng.randint(3, 12)),
+        'firm': rng.choice(firms) if rng.random() < 0.8 else None,
+        'city': city,
+        'state': state,
+        'country': country,
+        'ipcs': [(rng.choice(ipcs), rng.randint(1, 999), rng.randint(0, 99)) for _ in range(rng.randint(1, 4))],
+        'claims': rng.randint(1, 40),
+        'abstract': [sentence(rng, rng.randint(20, 120)) for _ in range(rng.randint(1, 3))],
+    }
+
+def wrap(text, width=70):
+    return [text[i:i+width] for i in range(0, max(len(text), 1), width)]
+
+# gen 1: APS fixed tag text
+def write_gen1(f, rng, n):
+    f.write('HHHHHT APS1 SYNTHETIC\n')
+    for i in range(n):
+        r = record(rng, i)
+        f.write('PATN\n')
+        f.write(f'WKU  {r["num"]:08d}{rng.randint(0, 9)}\n')
+        f.write(f'SRC  {rng.choice(["5", "6", "D"])}\n')
+        f.write(f'APN  {r["appnum"]:06d}{rng.randint(0, 9)}\n')
+        f.write(f'APD  {r["appdate"]}\n')
+        for j, line in enumerate(wrap(r['title'])):
+            f.write(('TTL  ' if j == 0 else '     ') + line + '\n')
+        f.write(f'ISD  {r["pubdate"]}\n')
+        f.write(f'NCL  {r["claims"]}\n')
+        f.write('INVT\nNAM  Doe; John\nCTY  Springfield\nSTA  IL\n')
+        if r['firm'] is not None:
+            f.write(f'ASSG\nNAM  {r["firm"]}\nCTY  {r["city"]}\n')
+            if r['state']:
+                f.write(f'STA  {r["state"]}\n')
+            else:
+                f.write(f'CNT  {r["country"]}X\n')
+            f.write('COD  02\n')
+        f.write('CLAS\nOCL  123/456\nEDF  2\n')
+        for sec, grp, sub in r['ipcs']:
+            f.write(f'ICL  {sec}{grp:3d}{sub:02d}\n')
+        f.write('UREF\nPNO  1234567\nISD  19700101\n')
+        f.write('ABST\n')
+        for j, par in enumerate(r['abstract']):
+            for k, line in enumerate(wrap(par)):
+                f.write(('PAL  ' if k == 0 else '     ') + line + '\n')
+
+# gen 2 grant: SGML-ish pgb
+def write_pgb(f, rng, n):
+    for i in range(n):
+        r = record(rng, i, base=6330000)
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE PATDOC SYSTEM "ST32-US-Grant-025xml.dtd" [\n')
+        f.write('<!ENTITY US03930001-20020101-D00000.TIF SYSTEM "US03930001-20020101-D00000.TIF" NDATA TIF>\n')
+        f.write(']>\n')
+        f.write('<PATDOC DTD="2.5" STATUS="Build 20011213">\n<SDOBI>\n')
+        f.write(f'<B100><B110><DNUM><PDAT>0{r["num"]}</PDAT></DNUM></B110><B130><PDAT>B1</PDAT></B130>'
+                f'<B140><DATE><PDAT>{r["pubdate"]}</PDAT></DATE></B140></B100>\n')
+        f.write(f'<B200><B210><DNUM><PDAT>09{r["appnum"]}</PDAT></DNUM></B210>'
+                f'<B220><DATE><PDAT>{r["appdate"]}</PDAT></DATE></B220></B200>\n')
+        f.write('<B500>\n<B510><B516><PDAT>7</PDAT></B516>')
+        for j, (sec, grp, sub) in enumerate(r['ipcs']):
+            tag = 'B511' if j == 0 else 'B512'
+            f.write(f'<{tag}><PDAT>{sec}{grp:3d}{sub:02d}</PDAT></{tag}>')
+        f.write('</B510>\n')
+        f.write(f'<B540><STEXT><PDAT>{r["title"]}</PDAT></STEXT></B540>\n')
+        f.write(f'<B570><B577><PDAT>{r["claims"]}</PDAT></B577></B570>\n</B500>\n')
+        if r['firm'] is not None:
+            f.write(f'<B700><B730><B731><PARTY-US><NAM><ONM><STEXT><PDAT>{r["firm"]}</PDAT></STEXT></ONM></NAM>'
+                    f'<ADR><CITY><PDAT>{r["city"]}</PDAT></CITY><STATE><PDAT>{r["state"]}</PDAT></STATE>'
+                    f'<CTRY><PDAT>{r["country"]}</PDAT></CTRY></ADR></PARTY-US></B731></B730></B700>\n')
+        f.write('</SDOBI>\n<SDOAB><BTEXT>\n')
+        for par in r['abstract']:
+            f.write(f'<PARA ID="P-00001" LVL="0"><PTEXT><PDAT>{par}</PDAT></PTEXT></PARA>\n')
+        f.write('</BTEXT></SDOAB>\n</PATDOC>\n')
+
+# gen 3 grant: ipgb
+def write_ipgb(f, rng, n):
+    for i in range(n):
+        r = record(rng, i, base=7000000)
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE us-patent-grant SYSTEM "us-patent-grant-v42-2006-08-23.dtd" [ ]>\n')
+        f.write('<us-patent-grant lang="EN" dtd-version="v4.2 2006-08-23" file="US07000001-20060101.XML">\n')
+        f.write('<us-bibliographic-data-grant>\n')
+        f.write(f'<publication-reference><document-id><country>US</country><doc-number>0{r["num"]}</doc-number>'
+                f'<kind>B2</kind><date>{r["pubdate"]}</date></document-id></publication-reference>\n')
+        f.write(f'<application-reference appl-type="utility"><document-id><country>US</country>'
+                f'<doc-number>10{r["appnum"]}</doc-number><date>{r["appdate"]}</date></document-id></application-reference>\n')
+        f.write('<classifications-ipcr>\n')
+        for sec, grp, sub in r['ipcs']:
+            f.write(f'<classification-ipcr><ipc-version-indicator><date>20060101</date></ipc-version-indicator>'
+                    f'<section>{sec[0]}</section><class>{sec[1:3]}</class><subclass>{sec[3]}</subclass>'
+                    f'<main-group>{grp}</main-group><subgroup>{sub:02d}</subgroup></classification-ipcr>\n')
+        f.write('</classifications-ipcr>\n')
+        f.write(f'<invention-title id="d0e53">{r["title"]}</invention-title>\n')
+        f.write(f'<number-of-claims>{r["claims"]}</number-of-claims>\n')
+        if r['firm'] is not None:
+            f.write(f'<assignees><assignee><addressbook><orgname>{xml_escape(r["firm"])}</orgname><role>02</role>'
+                    f'<address><city>{r["city"]}</city><state>{r["state"]}</state><country>{r["country"]}</country>'
+                    f'</address></addressbook></assignee></assignees>\n')
+        f.write('</us-bibliographic-data-grant>\n<abstract id="abstract">\n')
+        for par in r['abstract']:
+            f.write(f'<p id="p-0001" num="0000">{par}</p>\n')
+        f.write('</abstract>\n</us-patent-grant>\n')
+
+# gen 2 apply: pab
+def write_pab(f, rng, n):
+    for i in range(n):
+        r = record(rng, i)
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE patent-application-publication SYSTEM "pap-v16-2002-01-01.dtd" [\n')
+        f.write('<!ENTITY US20020000001A1-20020103-D00000.TIF SYSTEM "US20020000001A1-20020103-D00000.TIF" NDATA TIF>\n')
+        f.write(']>\n')
+        f.write('<patent-application-publication>\n<subdoc-bibliographic-information>\n')
+        f.write(f'<document-id><doc-number>2002{r["num"]:07d}</doc-number><kind-code>A1</kind-code>'
+                f'<document-date>{r["pubdate"]}</document-date></document-id>\n')
+        f.write(f'<domestic-filing-data><application-number><doc-number>09{r["appnum"]}</doc-number></application-number>'
+                f'<application-number-series-code>09</application-number-series-code><filing-date>{r["appdate"]}</filing-date>'
+                f'</domestic-filing-data>\n')
+        f.write('<technical-information><classification-ipc><classification-ipc-primary>')
+        for j, (sec, grp, sub) in enumerate(r['ipcs']):
+            ipc = f'{sec}{grp:03d}/{sub:02d}'
+            if j == 0:
+                f.write(f'<ipc>{ipc}</ipc></classification-ipc-primary>')
+            else:
+                f.write(f'<classification-ipc-secondary><ipc>{ipc}</ipc></classification-ipc-secondary>')
+        f.write('<classification-ipc-edition>07</classification-ipc-edition></classification-ipc>\n')
+        f.write(f'<title-of-invention>{r["title"]}</title-of-invention></technical-information>\n')
+        f.write('<inventors><first-named-inventor><name><given-name>John</given-name><family-name>Doe</family-name></name>'
+                f'<residence><residence-us><city>{r["city"]}</city><state>{r["state"]}</state>'
+                f'<country-code>{r["country"]}</country-code></residence-us></residence></first-named-inventor></inventors>\n')
+        if r['firm'] is not None:
+            f.write(f'<assignee><organization-name>{xml_escape(r["firm"])}</organization-name></assignee>\n')
+        f.write('</subdoc-bibliographic-information>\n<subdoc-abstract>\n')
+        for par in r['abstract']:
+            f.write(f'<paragraph id="A-0001" lvl="0">{par}</paragraph>\n')
+        f.write('</subdoc-abstract>\n</patent-application-publication>\n')
+
+# gen 3 apply: ipab
+def write_ipab(f, rng, n):
+    for i in range(n):
+        r = record(rng, i)
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<!DOCTYPE us-patent-application SYSTEM "us-patent-application-v42-2006-08-23.dtd" [ ]>\n')
+        f.write('<us-patent-application lang="EN" dtd-version="v4.2 2006-08-23" file="US20070000001A1-20070104.XML">\n')
+        f.write('<us-bibliographic-data-application>\n')
+        f.write(f'<publication-reference><document-id><country>US</country><doc-number>2007{r["num"]:07d}</doc-number>'
+                f'<kind>A1</kind><date>{r["pubdate"]}</date></document-id></publication-reference>\n')
+        f.write(f'<application-reference appl-type="utility"><document-id><country>US</country>'
+                f'<doc-number>11{r["appnum"]}</doc-number><date>{r["appdate"]}</date></document-id></application-reference>\n')
+        f.write('<classifications-ipcr>\n')
+        for sec, grp, sub in r['ipcs']:
+            f.write(f'<classification-ipcr><ipc-version-indicator><date>20060101</date></ipc-version-indicator>'
+                    f'<section>{sec[0]}</section><class>{sec[1:3]}</class><subclass>{sec[3]}</subclass>'
+                    f'<main-group>{grp}</main-group><subgroup>{sub:02d}</subgroup></classification-ipcr>\n')
+        f.write('</classifications-ipcr>\n')
+        f.write(f'<invention-title id="d0e43">{r["title"]}</invention-title>\n')
+        f.write('<us-parties><us-applicants><us-applicant sequence="001" app-type="applicant-inventor"><addressbook>'
+                f'<last-name>Doe</last-name><first-name>John</first-name><address><city>{r["city"]}</city>'
+                f'<state>{r["state"]}</state><country>{r["country"]}</country></address></addressbook>'
+                '</us-applicant></us-applicants></us-parties>\n')
+        if r['firm'] is not None:
+            f.write(f'<assignees><assignee><addressbook><orgname>{xml_escape(r["firm"])}</orgname><role>02</role>'
+                    '</addressbook></assignee></assignees>\n')
+        f.write('</us-bibliographic-data-application>\n<abstract id="abstract">\n')
+        for par in r['abstract']:
+            f.write(f'<p id="p-0001" num="0000">{par}</p>\n')
+        f.write('</abstract>\n</us-patent-application>\n')
+
+def xml_escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+# file names follow the uspto conventions so generation detection works
+formats = {
+    'gen1': ('1976.dat', write_gen1, 'latin1'),
+    'pgb': ('pgb20020101_wk01.xml', write_pgb, 'utf-8'),
+    'ipgb': ('ipgb20060103_wk01.xml', write_ipgb, 'utf-8'),
+    'pab': ('pab20020103_wk01.xml', write_pab, 'utf-8'),
+    'ipab': ('ipab20070104_wk01.xml', write_ipab, 'utf-8'),
+}
+
+def make_file(fmt, n, outdir='.', seed=0):
+    fname, writer, enc = formats[fmt]
+    path = os.path.join(outdir, fname)
+    rng = random.Random(seed)
+    with open(path, 'w', encoding=enc) as f:
+        writer(f, rng, n)
+    return path
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='generate synthetic uspto files')
+    parser.add_argument('formats', type=str, nargs='*', default=list(formats), help='formats to generate')
+    parser.add_argument('--num', type=int, default=1000, help='documents per file')
+    parser.add_argument('--outdir', type=str, default='.', help='directory to write to')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    for fmt in args.formats:
+        path = make_file(fmt, args.num, outdir=args.outdir, seed=args.seed)
+        print(f'{fmt}: {path} ({os.path.getsize(path)} bytes)')